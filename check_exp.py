@@ -11,8 +11,12 @@ from __future__ import print_function
 
 """
 import sys
+import os
 import re
 from optparse import OptionParser
+from gene_file import scan_gene_file, GENE_WORKERS_DEFAULT, GENE_FORMATS
+from text_file import open_input, open_output
+from validation import line_sampler, VALIDATE_LEVELS, VALIDATE_DEFAULT
 
 __version__ = 1.0
 __date__ = '2015-06-27'
@@ -23,6 +27,41 @@ Q_THRESHOLD_DEFAULT = 0.05
 Q_COLUMN_DEFAULT = 12
 USE_TYPE_DEFAULT = 'b'
 EXP_THRESHOLD_DEFAULT = 0.0
+GENE_COLUMN_DEFAULT = 2
+EXP_COLUMN1_DEFAULT = 7
+EXP_COLUMN2_DEFAULT = 8
+USE_TYPES = ('u', 'd', 'b')
+
+
+def make_variants(q_thresholds, exp_thresholds, use_types):
+    """List every combination of thresholds and directions.
+
+    Keyword arguments:
+    q_thresholds -- List of maximum thresholds of q-value
+    exp_thresholds -- List of minimum thresholds of expression value
+    use_types -- List of u: up only, d: down only, b: both
+    Returns: List of (q_threshold, exp_threshold, use_type)
+
+    """
+    variants = []
+    for q_threshold in q_thresholds:
+        for exp_threshold in exp_thresholds:
+            for use_type in use_types:
+                variants.append((q_threshold, exp_threshold, use_type))
+    return variants
+
+
+def variant_file(out_file, variant):
+    """Name the output file of a variant, e.g. out_exp_q0.05_x0_b.txt.
+
+    Keyword arguments:
+    out_file -- Output file
+    variant -- (q_threshold, exp_threshold, use_type)
+    Returns: String
+
+    """
+    root, ext = os.path.splitext(out_file)
+    return '%s_q%g_x%g_%s%s' % (root, variant[0], variant[1], variant[2], ext)
 
 
 def read_gene_diff_file(gene_file, gene_diff_file, gene_col, 
@@ -39,81 +78,44 @@ def read_gene_diff_file(gene_file, gene_diff_file, gene_col,
     Returns: Dictionary
 
     """
-    ecount = 0
-    count = 0
-    gene2exp = {}
-    qvals = []
-    try:
-        fh = open(gene_file, 'r')
-    except IOError as e:
-        sys.stderr.write(e.strerror + ":" + gene_file + "\n")
-        sys.exit()
-
-    file_part = re.compile('.*\.gtf$', re.I)
-    file_part2 = re.compile('.*\.gff3?$', re.I)
-    id_part = re.compile('gene_id\s"(\S+)";')
-    id_part2 = re.compile('.+Name=(\w+);')
-    column_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
-    if (file_part.search(gene_file) is None) \
-       and (file_part2.search(gene_file) is None):
-        print('Error: Fail to open ' + \
-            gene_file + 'with unknown file extentions.', file=sys.stderr)
-        sys.exit()
+    return read_gene_diff_variants(gene_file, gene_diff_file, gene_col,
+                                   q_column, ecol1, ecol2,
+                                   [(q_threshold, exp_threshold, use_type)])[0]
 
-    for rline in fh:
-        count += 1
-        if rline in ('\n', '\r'):
-            ecount += 1
-            continue
-
-        if 0 == rline.find('#'):
-            if file_part2.search(gene_file) is not None:
-                ecount += 1
-                continue
-
-        garr = rline.split('\t')
 
-        if 9 > len(garr):
-            print('Error: Less columns at line ' + \
-                str(count) + ' in ' + gene_file, file=sys.stderr)
-            sys.exit()
-
-        if None is column_part.search(garr[3]):
-            print('Error: Non-numeric value at line ' + \
-                str(count) + ' column 4 in ' + gene_file, file=sys.stderr)
-            sys.exit()
+def read_gene_diff_variants(gene_file, gene_diff_file, gene_col, q_column,
+                            ecol1, ecol2, variants, metrics=None,
+                            gene_workers=GENE_WORKERS_DEFAULT,
+                            validate=VALIDATE_DEFAULT, gene_format=None):
+    """generate expression files for LAMP in a single pass.
 
-        if None is column_part.search(garr[4]):
-            print('Error: Non-numeric value at line ' + \
-                str(count) + ' column 5 in ' + gene_file, file=sys.stderr)
-            sys.exit()
-
-        feat = garr[2]
-        #if feat == "-":
-        #    feat = garr[1]
-        info = garr[8]
-
-        if file_part.search(gene_file) is not None:
-            if id_part.search(info) is not None and feat == 'exon':
-                gene = id_part.match(info).group(1)
-                gene2exp[gene] = 0
-
-        if file_part2.search(gene_file) is not None:
-            if id_part2.search(info) is not None and \
-               (feat == 'gene' or feat == 'exon'):
-                gene = id_part2.match(info).group(1)
-                gene2exp[gene] = 0
+    Keyword arguments:
+    geneFile -- Gene file in gtf/gff3 format
+    geneDiffFile -- Gene expression file created by cuffdiff, '-' reads
+                    the standard input
+    variants -- List of (q_threshold, exp_threshold, use_type)
+    metrics -- Metrics receiving the line counts
+    gene_workers -- Number of processes parsing the gene file
+    validate -- Validation level of the numeric columns
+    gene_format -- gtf or gff3, None resolves it from the extension
+    Returns: List of sorted (gene, expression) lists, one per variant
 
-    fh.close()
-    if count - ecount <= 0:
-        print('Error: No valid line in ' + gene_file, file=sys.stderr)
-        sys.exit()
+    """
+    gene2exp = {}
+    column_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
+    checked = line_sampler(validate)
+    for record in scan_gene_file(gene_file, metrics, gene_workers,
+                                 validate=validate, file_type=gene_format):
+        gene2exp[record[4]] = 0
 
     ecount = 0
     count = 0
+    ncount = 0
+    ucount = 0
+    gene2exps = [dict(gene2exp) for variant in variants]
 
     try:
-        fh_2 = open(gene_diff_file, 'r')
+        fh_2 = open_input(gene_diff_file)
     except IOError as e:
         sys.stderr.write(e.strerror + ":" + gene_diff_file + "\n")
         sys.exit()
@@ -130,51 +132,84 @@ def read_gene_diff_file(gene_file, gene_diff_file, gene_col,
                 str(count) + ' in ' + gene_diff_file, file=sys.stderr)
             sys.exit()
 
-        if None is column_part.search(darr[ecol1]):
-            print('Error: Non-numeric value at line ' + \
-                str(count) + ' column ' + str(ecol1+1) + ' in ' + gene_diff_file, file=sys.stderr)
-            sys.exit()
-        if None is column_part.search(darr[ecol2]):
-            print('Error: Non-numeric value at line ' + \
-                str(count) + ' column ' + str(ecol2+1) + ' in ' + gene_diff_file, file=sys.stderr)
-            sys.exit()
-
-        if None is column_part.search(darr[q_column]):
-            print('Error: Non-numeric value at line ' + \
-                str(count) + ' column ' + str(qcolumn+1) + ' in ' + gene_diff_file, file=sys.stderr)
-            sys.exit()
+        if checked(count):
+            if None is column_part.search(darr[ecol1]):
+                print('Error: Non-numeric value at line ' + \
+                    str(count) + ' column ' + str(ecol1+1) + ' in ' + gene_diff_file, file=sys.stderr)
+                sys.exit()
+            if None is column_part.search(darr[ecol2]):
+                print('Error: Non-numeric value at line ' + \
+                    str(count) + ' column ' + str(ecol2+1) + ' in ' + gene_diff_file, file=sys.stderr)
+                sys.exit()
+
+            if None is column_part.search(darr[q_column]):
+                print('Error: Non-numeric value at line ' + \
+                    str(count) + ' column ' + str(q_column+1) + ' in ' + gene_diff_file, file=sys.stderr)
+                sys.exit()
 
         gene_str = darr[gene_col]
         gene_arr = gene_str.split(',')
-        val1 = float(darr[ecol1])
-        val2 = float(darr[ecol2])
-        q = float(darr[q_column])
+        try:
+            val1 = float(darr[ecol1])
+            val2 = float(darr[ecol2])
+            q = float(darr[q_column])
+        except ValueError:
+            print('Error: Non-numeric value at line ' + \
+                str(count) + ' in ' + gene_diff_file, file=sys.stderr)
+            sys.exit()
         #sys.stderr.write("%s %f\n" % (gene_str, q))
 
-        #if val1 < val2:
-        #    tipe = 'u'
-        #else:
-        #    tipe = 'd'
+        if val1 < val2:
+            tipe = 'u'
+        else:
+            tipe = 'd'
 
         if gene_str == '-':
+            ncount += 1
             continue
-        if q > q_threshold:
-            continue
-        #if (use_type != 'b') and (use_type != tipe):
-        #    continue
-        if (val1 < exp_threshold) and (val2 < exp_threshold):
-            continue
+        if metrics is not None:
+            for gline in gene_arr:
+                if gline in gene2exp:
+                    break
+            else:
+                ucount += 1
+        for (q_threshold, exp_threshold, use_type), gene2exp in \
+                zip(variants, gene2exps):
+            if q > q_threshold:
+                continue
+            if (use_type != 'b') and (use_type != tipe):
+                continue
+            if (val1 < exp_threshold) and (val2 < exp_threshold):
+                continue
 
-        for gline in gene_arr:
-            if gline in gene2exp:
-                gene2exp[gline] = 1
-                qvals.append(q)
+            for gline in gene_arr:
+                if gline in gene2exp:
+                    gene2exp[gline] = 1
     fh_2.close()
     if count - ecount <= 0:
         print('Error: No valid line in ' + gene_diff_file, file=sys.stderr)
         sys.exit()
-    rlist = sorted(list(gene2exp.items()), key=lambda x: x[0])
-    return rlist
+    if metrics is not None:
+        degs = {}
+        for variant, gene2exp in zip(variants, gene2exps):
+            degs['q%g_x%g_%s' % variant] = sum(gene2exp.values())
+        metrics.record(gene_diff_file, {
+            'lines': count, 'genes_not_in_annotation': ucount,
+            'skipped': {'header_blank_or_comment': ecount, 'no_gene': ncount},
+            'deg_genes': degs})
+    rlists = []
+    for gene2exp in gene2exps:
+        rlists.append(sorted(list(gene2exp.items()), key=lambda x: x[0]))
+    return rlists
+
+def write_exp_file(gene2exp, out_file):
+    fout = open_output(out_file)
+    fout.write('#gene,expression' + '\n')
+    for wline in range(len(gene2exp)):
+        fout.write(str(gene2exp[wline][0]) + ',' +
+                   str(gene2exp[wline][1]) + '\n')
+    fout.close()
+
 
 def check_exp(gene_file, gene_diff_file, gene_col,
               q_threshold, q_column, exp_threshold,
@@ -184,69 +219,124 @@ def check_exp(gene_file, gene_diff_file, gene_col,
                                    q_threshold,q_column,  exp_threshold,
                                    exp_column1, exp_column2,
                                    use_type)
-    fout = open(out_file, 'w')
-    fout.write('#gene,expression' + '\n')
-    for wline in range(len(gene2exp)):
-        fout.write(str(gene2exp[wline][0]) + ',' +
-                   str(gene2exp[wline][1]) + '\n')
-    fout.close()
+    write_exp_file(gene2exp, out_file)
 
 
-def main():
-    gene2exp = {}
-    use_type = USE_TYPE_DEFAULT
+def check_exp_variants(gene_file, gene_diff_file, gene_col, q_column,
+                       exp_column1, exp_column2, variants, out_files,
+                       metrics=None, gene_workers=GENE_WORKERS_DEFAULT,
+                       validate=VALIDATE_DEFAULT, gene_format=None):
+    gene2exps = read_gene_diff_variants(gene_file, gene_diff_file, gene_col,
+                                        q_column, exp_column1, exp_column2,
+                                        variants, metrics, gene_workers,
+                                        validate, gene_format)
+    for gene2exp, out_file in zip(gene2exps, out_files):
+        write_exp_file(gene2exp, out_file)
 
+
+def main():
     try:
         parser = OptionParser()
         parser.add_option(
             '-g', '--gene', action='store', dest='arg_gene',
             default='',
             help='Gene file in gtf/gff3 format')
+        parser.add_option(
+            '--gcol', action='store', dest='arg_gcol', type='int',
+            default=GENE_COLUMN_DEFAULT,
+            help='Gene name column in expression file')
         parser.add_option(
             '-d', '--diff', action='store', dest='arg_diff',
             default='',
-            help='Gene expression file created by cuffdiff')
+            help='Gene expression file created by cuffdiff(- reads ' + \
+                 'the standard input)')
         parser.add_option(
             '-o', '--out', action='store', dest='arg_out',
             default='',
             help='Output file')
         parser.add_option(
-            '-q', '--qval', action='store', dest='arg_qval', type='float',
-            default=Q_THRESHOLD_DEFAULT,
-            help='Maximum thhreshold of q-value(a non-negative value)')
+            '-q', '--qval', action='store', dest='arg_qval',
+            default=str(Q_THRESHOLD_DEFAULT),
+            help='Maximum thhreshold of q-value(non-negative values listed in commas)')
         parser.add_option(
             '-m', '--qcol', action='store',
             dest='arg_qcol', type='int',
             default=Q_COLUMN_DEFAULT,
             help='Coumn number of q-value to be used')
         parser.add_option(
-            '-e', '--exp', action='store', dest='arg_exp', type='float',
-            default=EXP_THRESHOLD_DEFAULT,
-            help='Minimum threshold of expression value(a non-negative value)')
+            '-e', '--exp', action='store', dest='arg_exp',
+            default=str(EXP_THRESHOLD_DEFAULT),
+            help='Minimum threshold of expression value(non-negative values listed in commas)')
+        parser.add_option(
+            '--ecol1', action='store', dest='arg_ecol1', type='int',
+            default=EXP_COLUMN1_DEFAULT,
+            help='Column number of expression value 1')
+        parser.add_option(
+            '--ecol2', action='store', dest='arg_ecol2', type='int',
+            default=EXP_COLUMN2_DEFAULT,
+            help='Column number of expression value 2')
+        parser.add_option(
+            '-t', '--type', action='store', dest='arg_type',
+            default=USE_TYPE_DEFAULT,
+            help='u: up only, d: down only, b: both(listed in commas)')
+        parser.add_option(
+            '--gene-workers', action='store', dest='arg_gene_workers',
+            type='int', default=GENE_WORKERS_DEFAULT,
+            help='Number of processes parsing the gene file')
+        parser.add_option(
+            '--validate', action='store', dest='arg_validate',
+            default=VALIDATE_DEFAULT,
+            help='Numeric field checks: full(every line), sample(a ' + \
+                 'prefix and a random sample) or none')
+        parser.add_option(
+            '--gene-format', action='store', dest='arg_gene_format',
+            default=None,
+            help='Format of the gene file(gtf or gff3), by default ' + \
+                 'from its extension')
         (opt, args) = parser.parse_args()
         arg = opt.__dict__
         gene_file = arg['arg_gene']
+        gene_col = arg['arg_gcol']
         gene_diff_file = arg['arg_diff']
         out_file = arg['arg_out']
-        q_threshold = arg['arg_qval']
-        exp_threshold = arg['arg_exp']
+        q_column = arg['arg_qcol']
+        q_thresholds = [float(x) for x in arg['arg_qval'].split(',')]
+        exp_thresholds = [float(x) for x in arg['arg_exp'].split(',')]
         exp_column1 = arg['arg_ecol1']
         exp_column2 = arg['arg_ecol2']
+        use_types = arg['arg_type'].split(',')
+        gene_workers = arg['arg_gene_workers']
+        validate = arg['arg_validate']
+        gene_format = arg['arg_gene_format']
         if '' in (gene_file, gene_diff_file, out_file):
             raise TypeError()
-        if q_threshold < 0 or exp_threshold < 0:
+        if min(q_thresholds) < 0 or min(exp_thresholds) < 0:
+            raise TypeError()
+        if gene_workers < 1 or validate not in VALIDATE_LEVELS:
             raise TypeError()
+        if gene_format not in (None,) + GENE_FORMATS:
+            raise TypeError()
+        for use_type in use_types:
+            if use_type not in USE_TYPES:
+                raise TypeError()
     except:
         print(('Usage:' + ' ' + str(sys.argv[0]) + \
             ' --gene genes.gtf --diff gene_exp.diff --out out_exp.txt [--qval ' + \
               str(Q_THRESHOLD_DEFAULT) + '] [--exp ' + \
-              str(EXP_THRESHOLD_DEFAULT) + ']'))
+              str(EXP_THRESHOLD_DEFAULT) + '] [--type ' + \
+              USE_TYPE_DEFAULT + '] [--gene-workers ' + \
+              str(GENE_WORKERS_DEFAULT) + '] [--validate full|sample|none]' + \
+              ' [--gene-format gtf|gff3]'))
         sys.exit()
 
-    check_exp(gene_file, gene_diff_file, gene_col, 
-              q_threshold, exp_threshold,
-              exp_column1, exp_column2,
-              use_type, out_file)
+    variants = make_variants(q_thresholds, exp_thresholds, use_types)
+    out_files = [out_file]
+    if len(variants) > 1:
+        out_files = [variant_file(out_file, variant) for variant in variants]
+    check_exp_variants(gene_file, gene_diff_file, gene_col, q_column,
+                       exp_column1, exp_column2, variants, out_files,
+                       gene_workers=gene_workers, validate=validate,
+                       gene_format=gene_format)
 
 
 if __name__ == '__main__':
@@ -11,8 +11,30 @@ from __future__ import print_function
 """
 
 import sys
+import os
 import re
+import shutil
+import tempfile
+import threading
+import bisect
+import mmap
+import ast
+import struct
+import multiprocessing
+from collections import deque
+from array import array
 from optparse import OptionParser
+from gene_file import scan_gene_file, chrom_index, GENE_WORKERS_DEFAULT, \
+    CHROM_INDEX_SUFFIX, GENE_FORMATS
+from metrics import Metrics
+from text_file import open_input, open_output, is_stream, compressor, \
+    STDIN
+from validation import line_sampler, VALIDATE_LEVELS, VALIDATE_DEFAULT
+from checkpoint import checkpoint_key, checkpoint_file, part_file, commit_file
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 __version__ = 1.0
 __date__ = '2015-06-27'
@@ -25,6 +47,49 @@ SCO_THRESHOLD = 0.0
 #DEFAULT_VALUE = -sys.maxint for Python2
 #DEFAULT_VALUE = -sys.maxsize for Python3
 DEFAULT_VALUE = -1000000
+PREFETCH_DEFAULT = 0 # reader threads, 0 reads peak files inline
+PREFETCH_DEPTH = 4 # chunks buffered per reader thread
+CHUNK_LINES = 10000 # peaks per chunk
+# strand codes of GeneRecord
+PLUS = 1
+MINUS = -1
+OTHER = 0
+BIN_BITS = 16 # bins of binFromRangeStandard fit below 2**16
+# suffixes of the binary output written with --npy
+NPY_FLAG_SUFFIX = '_flag.npy'
+NPY_DIST_SUFFIX = '_dist.npy'
+NPY_GENE_SUFFIX = '_genes.txt'
+NPY_LABEL_SUFFIX = '_labels.txt'
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+NEAREST_DEFAULT = 0 # nearest peaks reported per gene, 0 disables
+MEMORY_DEFAULT = 0 # MB for flag and distance columns, 0 keeps all in memory
+COLUMN_BYTES = array('b').itemsize + array('l').itemsize # per gene and file
+MERGE_FANIN = 128 # spill files opened at once when blocks are joined
+WORKERS_DEFAULT = 1 # processes computing peak files
+POOL_DEPTH = 2 # peak files submitted per worker process at a time
+SHARED_HEADER = struct.Struct('<qq') # keys and records of the shared index
+sharedIndex = None # index attached by a worker process
+INDEX_STATS_TOP = 10 # largest bins listed by the index counters
+INDEX_VERSION = 5 # part of checkpoint keys, bumped when lookups change
+NARROWPEAK_COLUMNS = 10 # columns of MACS2 narrowPeak records
+SUMMIT_COLUMN = 9 # summit offset from the peak start in narrowPeak
+
+
+class GeneRecord(object):
+    """Gene record stored in bin2genes.
+
+    chrom and strand are integer codes, gene is the index of the gene in
+    the list returned by readGeneFile.
+    """
+
+    __slots__ = ('chrom', 'sta', 'end', 'strand', 'gene')
+
+    def __init__(self, chrom, sta, end, strand, gene):
+        self.chrom = chrom
+        self.sta = sta
+        self.end = end
+        self.strand = strand
+        self.gene = gene
 
 
 def binFromRangeStandard(sta, end):
@@ -60,127 +125,129 @@ def binFromRangeStandard(sta, end):
     return(upper, lower)
 
 
-def readGeneFile(geneFile, peakFiles):
-    """Set default value to gene2peaks.
+def readGeneFile(geneFile, metrics=None, workers=GENE_WORKERS_DEFAULT,
+                 loadChroms=None, validate=VALIDATE_DEFAULT, geneFormat=None):
+    """Build the bin index of gene records.
+
+    bin2genes is keyed by (chromosome code << BIN_BITS) | bin so that a
+    lookup only returns records of the peak's own chromosome.
 
     Keyword arguments:
     geneFile  -- Gene file in gtf/gff3 format
-    peakFiles -- List of peak files
-    Returns: Dictionary, Dictionary
+    metrics -- Metrics receiving the line counts
+    workers -- Number of processes parsing the gene file
+    loadChroms -- Set of chromosomes whose records are loaded, None loads
+                  all; the genes of the others are still numbered
+    validate -- Validation level of the numeric columns
+    geneFormat -- gtf or gff3, None resolves it from the extension
+    Returns: Dictionary, List, Dictionary
 
     """
 
     bin2genes = {}
-    gene2peaks = {}
-    r_geneFile = open(geneFile)
-    count = 0
-    ecount = 0
-    file_part = re.compile('.*\.gtf$', re.I)
-    file_part2 = re.compile('.*\.gff3?$', re.I)
-    id_part = re.compile('gene_id\s"(\S+)";')
-    id_part2 = re.compile('.+Name=(\w+);')
-    retsu_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
-
-    if (file_part.search(geneFile) is None) \
-       and (file_part2.search(geneFile) is None):
-        print('Error: Fail to open ' + \
-              geneFile + 'with unknown file extentions.',
-              file=sys.stderr)
-        sys.exit()
+    genes = []
+    gene2idx = {}
+    chroms = {}
+    strands = {'+': PLUS, '-': MINUS}
 
-    for fh in r_geneFile:
-        count += 1
-        if fh in ('\n', '\r'):
-            ecount += 1
+    for chrom, sta, end, strand, gene in scan_gene_file(
+            geneFile, metrics, workers, loadChroms, validate, geneFormat):
+        if gene not in gene2idx:
+            gene2idx[gene] = len(genes)
+            genes.append(gene)
+        if chrom not in chroms:
+            chroms[chrom] = len(chroms)
+        if sta is None:
+            # gene of a chromosome without peaks
             continue
-        if 0 == fh.find('#'):
-            if file_part2.search(geneFile) is not None:
-                ecount += 1
-                continue
+        upperBins, lowerBins = binFromRangeStandard(sta, end)
+        ownBin = upperBins[0]
+        key = (chroms[chrom] << BIN_BITS) | ownBin
+        if key in bin2genes:
+            tmp = bin2genes[key]
+        else:
+            tmp = []
+        x = GeneRecord(chroms[chrom], sta, end,
+                       strands.get(strand, OTHER), gene2idx[gene])
+        tmp.append(x)
+        bin2genes[key] = tmp
 
-        arr = fh.split('\t')
-        if 9 > len(arr):
-            print('Error: Less columns at line ' + \
-                  str(count) + ' in ' + geneFile,
-                  file=sys.stderr)
-            sys.exit()
+    return bin2genes, genes, chroms
 
-        if None is retsu_part.search(arr[3]):
-            print(sys.stderr, 'Error: Non-numeric value at line ' + \
-                  str(count) + ' column 4 in ' + geneFile, file=sys.stderr)
-            sys.exit()
 
-        if None is retsu_part.search(arr[4]):
-            print('Error: Non-numeric value at line ' + \
-                  str(count) + ' column 5 in ' + geneFile,
-                  file=sys.stderr)
-            sys.exit()
+def peakChroms(peakFiles, sortedInput=False):
+    """Collect the chromosomes of peak files.
 
-        chrom = arr[0]
-        feat  = arr[2]
-        sta = int(arr[3]) - 1
-        end = int(arr[4])
-        strand = arr[6]
-        info = arr[8]
-        upperBins, lowerBins = binFromRangeStandard(sta, end)
-        ownBin = upperBins[0]
-        gene = ''
-
-        if file_part.search(geneFile) is not None:
-            if id_part.search(info) is not None and feat == 'exon':
-                gene = id_part.match(info).group(1)
-        if file_part2.search(geneFile) is not None:
-            if id_part2.search(info) is not None \
-               and (feat == 'gene' or feat == 'exon'):
-                gene = id_part2.match(info).group(1)
-
-        if gene != '':
-            if ownBin in bin2genes:
-                tmp = bin2genes[ownBin]
-            else:
-                tmp = []
-            x = {'chrom': chrom, 'sta': sta,
-                 'end': end, 'strand': strand, 'gene': gene}
-            tmp.append(x)
-            bin2genes[ownBin] = tmp
-            gene2peaks[gene] = {}
-            for peakFile in peakFiles:
-                gene2peaks[gene].update(
-                    {peakFile: {'flag': 0, 'dist': DEFAULT_VALUE}})
-    r_geneFile.close()
+    Sorted plain peak files get a sidecar chromosome index (see
+    chrom_index), so later runs do not read them; other files, including
+    .gz/.xz ones, are scanned for their first column.
+
+    Keyword arguments:
+    peakFiles -- List of peak files
+    sortedInput -- True if the peak files are sorted
+    Returns: Set of chromosomes
+
+    """
+    chroms = set()
+    for peakFile in peakFiles:
+        index = None
+        if sortedInput and compressor(peakFile) is None:
+            index = chrom_index(peakFile)
+        if index is not None:
+            chroms.update([x[0] for x in index])
+            continue
+        with open_input(peakFile) as fpeak:
+            for line in fpeak:
+                tab = line.find('\t')
+                if tab > 0:
+                    chroms.add(line[:tab])
+    return chroms
 
-    if count - ecount <= 0:
-        print(sys.stderr, 'Error: No valid line in ' + geneFile,
-              file=sys.stderr)
-        sys.exit()
 
-    return bin2genes, gene2peaks
+def parsePeakFile(peakfile, sco_threshold, macs_flg, sortedInput=False,
+                  metrics=None, chunk_size=CHUNK_LINES,
+                  validate=VALIDATE_DEFAULT, summit=False):
+    """Read a peak file and yield its peaks in chunks.
 
+    The file is read once from start to end, so it may be the standard
+    input or a named pipe.
 
-def readPeakFile(peakfile, bin2genes, gene2peaks, updist, indist, sco_threshold, macs_flg):
-    """Read peak files and set flag & distance to gene2peaks.
+    With summit, the file is in MACS2 narrowPeak format and each peak is
+    replaced by its summit, the one position peak [summit, summit + 1);
+    the summit offset is column 10, a negative offset takes the middle of
+    the peak.
 
     Keyword arguments:
-    peakfile -- Peak file
-    bin2genes -- Dictionary of bin to genes
-    gene2peaks -- Dictionary of gene to peaks
-    updist -- Distance upstream from tss
-    indist -- Distance downstream from tss
+    peakfile -- Peak file, '-' reads the standard input
     sco_threshold -- Score threshold
     macs_flg -- True if the peak files are generated by MACS2
-    Returns: Dictionary
+    sortedInput -- True to check that peaks are sorted by chromosome and
+                   start position
+    metrics -- Metrics receiving the line counts
+    chunk_size -- Number of peaks per chunk
+    validate -- Validation level of the numeric columns
+    summit -- True to read the summits of narrowPeak records
+    Returns: Generator of lists of (chrom, sta, end)
 
     """
     col_length = 5
     sco_col = 4 # the columun number for peak score
-    if macs_flg:
+    if summit:
+        col_length = NARROWPEAK_COLUMNS
+    elif macs_flg:
         col_length = 4
         sco_col = 3
-    r_file = open(peakfile, 'r')
-    tmp = {}
+    r_file = open_input(peakfile)
+    chunk = []
     count = 0
     ecount = 0
+    scount = 0
+    pcount = 0
+    prev_chrom = None
+    prev_sta = 0
+    done_chroms = set()
     retsu_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
+    checked = line_sampler(validate)
     for fh in r_file:
         count += 1
 
@@ -194,84 +261,810 @@ def readPeakFile(peakfile, bin2genes, gene2peaks, updist, indist, sco_threshold,
                   str(count) + ' in ' + peakfile, file=sys.stderr)
             sys.exit()
 
-        if None is retsu_part.search(arr[1]):
-            print(sys.stderr, 'Error: Non-numeric value at line ' + \
-                  str(count) + ' column 2 in ' + peakfile, file=sys.stderr)
-            sys.exit()
+        if checked(count):
+            if None is retsu_part.search(arr[1]):
+                print('Error: Non-numeric value at line ' + \
+                      str(count) + ' column 2 in ' + peakfile,
+                      file=sys.stderr)
+                sys.exit()
 
-        if None is retsu_part.search(arr[2]):
-            print('Error: Non-numeric value at line ' + \
-                  str(count) + ' column 3 in ' + peakfile,
-                  file=sys.stderr)
-            sys.exit()
-        if None is retsu_part.search(arr[sco_col]):
-#        if None is retsu_part.search(arr[4]):
+            if None is retsu_part.search(arr[2]):
+                print('Error: Non-numeric value at line ' + \
+                      str(count) + ' column 3 in ' + peakfile,
+                      file=sys.stderr)
+                sys.exit()
+            if None is retsu_part.search(arr[sco_col]):
+#            if None is retsu_part.search(arr[4]):
+                print('Error: Non-numeric value at line ' + \
+                      str(count) + ' column 5 in ' + peakfile,
+                      file=sys.stderr)
+                sys.exit()
+            if summit and None is retsu_part.search(arr[SUMMIT_COLUMN]):
+                print('Error: Non-numeric value at line ' + \
+                      str(count) + ' column ' + str(SUMMIT_COLUMN + 1) + \
+                      ' in ' + peakfile, file=sys.stderr)
+                sys.exit()
+
+        chrom = arr[0]
+        try:
+            sta = int(arr[1])
+            end = int(arr[2])
+#            sco = float(arr[4])
+            sco = float(arr[sco_col])
+            if summit:
+                offset = int(arr[SUMMIT_COLUMN])
+        except ValueError:
             print('Error: Non-numeric value at line ' + \
-                  str(count) + ' column 5 in ' + peakfile,
-                  file=sys.stderr)
+                  str(count) + ' in ' + peakfile, file=sys.stderr)
             sys.exit()
 
-        chrom = arr[0]
-        sta = int(arr[1])
-        end = int(arr[2])
-#        sco = float(arr[4])
-        sco = float(arr[sco_col])
+        if sortedInput:
+            if chrom != prev_chrom:
+                if chrom in done_chroms:
+                    print('Error: Peaks of ' + chrom + ' are not contiguous' + \
+                          ' at line ' + str(count) + ' in ' + peakfile,
+                          file=sys.stderr)
+                    sys.exit()
+                done_chroms.add(chrom)
+                prev_chrom = chrom
+            elif sta < prev_sta:
+                print('Error: Peaks are not sorted at line ' + \
+                      str(count) + ' in ' + peakfile, file=sys.stderr)
+                sys.exit()
+            prev_sta = sta
 
         if sco < sco_threshold:
+            scount += 1
             continue
-        upperBins, lowerBins = binFromRangeStandard(sta, end)
-        nlist = upperBins + lowerBins
+        pcount += 1
+        if summit:
+            if offset < 0:
+                offset = (end - sta) // 2
+            sta += offset
+            end = sta + 1
+        chunk.append((chrom, sta, end))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    r_file.close()
+    if count - ecount <= 0:
+        print('Error: No valid line in ' + peakfile, file=sys.stderr)
+        sys.exit()
+    if metrics is not None:
+        metrics.record(peakfile, {
+            'lines': count, 'peaks': pcount,
+            'skipped': {'blank': ecount, 'below_threshold': scount}})
+    if chunk:
+        yield chunk
+
+
+def readAhead(peakFiles, chunks, sco_threshold, macs_flg, sortedInput,
+              metrics, validate=VALIDATE_DEFAULT, summit=False):
+    """Parse peak files in a reader thread and queue their chunks.
+
+    Keyword arguments:
+    peakFiles -- List of peak files handled by this reader
+    chunks -- Bounded queue shared with the consumer
+    sco_threshold -- Score threshold
+    macs_flg -- True if the peak files are generated by MACS2
+    sortedInput -- True to check that peaks are sorted
+    metrics -- Metrics receiving the line counts
+    validate -- Validation level of the numeric columns
+    Returns: None
+
+    """
+    for peakFile in peakFiles:
+        try:
+            for chunk in parsePeakFile(peakFile, sco_threshold, macs_flg,
+                                       sortedInput, metrics,
+                                       validate=validate, summit=summit):
+                chunks.put(chunk)
+        except BaseException as e:
+            # Hand sys.exit() of a malformed file over to the main thread.
+            chunks.put(e)
+            return
+        chunks.put(None)
+
+
+def drainChunks(chunks):
+    """Yield the chunks of one peak file from a reader queue.
+
+    Keyword arguments:
+    chunks -- Queue filled by readAhead
+    Returns: Generator of lists of (chrom, sta, end)
+
+    """
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
+
+
+def prefetchPeakFiles(peakFiles, sco_threshold, macs_flg, prefetch,
+                      sortedInput=False, metrics=None,
+                      validate=VALIDATE_DEFAULT, summit=False):
+    """Read peak files ahead of the overlap computation.
 
-        for val in nlist:
-            if val not in bin2genes:
+    Peak file i is read by thread i % prefetch into its own queue holding
+    at most PREFETCH_DEPTH chunks, so readers block once they are that far
+    ahead and memory stays bounded.
+
+    Keyword arguments:
+    peakFiles -- List of peak files
+    sco_threshold -- Score threshold
+    macs_flg -- True if the peak files are generated by MACS2
+    prefetch -- Number of reader threads, 0 reads inline
+    sortedInput -- True to check that peaks are sorted
+    metrics -- Metrics receiving the line counts
+    validate -- Validation level of the numeric columns
+    summit -- True to read the summits of narrowPeak records
+    Returns: Generator of (peakFile, chunks)
+
+    """
+    if prefetch <= 0:
+        for peakFile in peakFiles:
+            yield peakFile, parsePeakFile(peakFile, sco_threshold, macs_flg,
+                                          sortedInput, metrics,
+                                          validate=validate, summit=summit)
+        return
+
+    prefetch = min(prefetch, len(peakFiles))
+    queues = []
+    for i in range(prefetch):
+        chunks = queue.Queue(PREFETCH_DEPTH)
+        reader = threading.Thread(
+            target=readAhead,
+            args=(peakFiles[i::prefetch], chunks, sco_threshold, macs_flg,
+                  sortedInput, metrics, validate, summit))
+        reader.daemon = True
+        reader.start()
+        queues.append(chunks)
+    for i in range(len(peakFiles)):
+        yield peakFiles[i], drainChunks(queues[i % prefetch])
+
+
+def sizeBucket(n):
+    """Histogram bucket of a count: 0, 1, 2-3, 4-7, 8-15, ..."""
+    if n < 2:
+        return str(n)
+    low = 1 << (n.bit_length() - 1)
+    return '%d-%d' % (low, 2 * low - 1)
+
+
+def indexStats(bin2genes, chroms, lookups=None):
+    """Occupancy of the bins of the bin index.
+
+    Keyword arguments:
+    bin2genes -- Dictionary of bin to genes
+    chroms -- Dictionary of chromosome to chromosome code
+    lookups -- Dictionary of bin key to the number of lookups by a peak
+               file, None counts every bin of the index once
+    Returns: Dictionary with the histogram of records per bin (weighted
+             by lookups) and the INDEX_STATS_TOP bins with the most
+             records scanned
+
+    """
+    if lookups is None:
+        lookups = dict.fromkeys(bin2genes, 1)
+    names = dict([(code, chrom) for chrom, code in chroms.items()])
+    histogram = {}
+    for key, n in lookups.items():
+        bucket = sizeBucket(len(bin2genes[key]))
+        histogram[bucket] = histogram.get(bucket, 0) + n
+    largest = sorted(lookups, key=lambda x: (-len(bin2genes[x]) * lookups[x],
+                                             x))[:INDEX_STATS_TOP]
+    return {'bin_occupancy': histogram,
+            'largest_bins': [{'chrom': names[key >> BIN_BITS],
+                              'bin': key & ((1 << BIN_BITS) - 1),
+                              'records': len(bin2genes[key]),
+                              'lookups': lookups[key]} for key in largest]}
+
+
+def readPeakFile(peakfile, bin2genes, chroms, flags, dists, updist, indist,
+                 sco_threshold, macs_flg, chunks=None, stats=None):
+    """Read peak files and set flag & distance of each gene.
+
+    Keyword arguments:
+    peakfile -- Peak file
+    bin2genes -- Dictionary of bin to genes
+    chroms -- Dictionary of chromosome to chromosome code
+    flags -- Flag column of peakfile indexed by gene
+    dists -- Distance column of peakfile indexed by gene
+    updist -- Distance upstream from tss
+    indist -- Distance downstream from tss
+    sco_threshold -- Score threshold
+    macs_flg -- True if the peak files are generated by MACS2
+    chunks -- Chunks of peaks already read by prefetchPeakFiles
+    stats -- Dictionary receiving the index counters, None skips them
+    Returns: None
+
+    """
+    if chunks is None:
+        chunks = parsePeakFile(peakfile, sco_threshold, macs_flg)
+    counting = stats is not None
+    npeaks = unknown = nbins = ncand = nhits = 0
+    perPeak = {}
+    lookups = {}
+    for chunk in chunks:
+        for chrom, sta, end in chunk:
+            if chrom not in chroms:
+                if counting:
+                    unknown += 1
                 continue
-            tmp = bin2genes[val]
-            for x in tmp:
+            chromKey = chroms[chrom] << BIN_BITS
+            upperBins, lowerBins = binFromRangeStandard(sta, end)
+            nlist = upperBins + lowerBins
+            if counting:
+                npeaks += 1
+                nbins += len(nlist)
+                cand = ncand
 
-                if x['chrom'] != chrom:
+            for val in nlist:
+                tmp = bin2genes.get(chromKey | val)
+                if tmp is None:
                     continue
+                if counting:
+                    ncand += len(tmp)
+                    lookups[chromKey | val] = \
+                        lookups.get(chromKey | val, 0) + 1
+                for x in tmp:
+                    # when strand of gene is plus
+                    if PLUS == x.strand:
+                        tss = x.sta
+                        if (sta <= (tss + indist)) and \
+                           ((tss - updist) <= end):
+                            g = x.gene
+                            flags[g] = 1
+                            if counting:
+                                nhits += 1
 
-                prev_dist = gene2peaks[x['gene']][peakfile]['dist']
+                            # 20150303
+                            if sta < tss:
+                                dist = tss - end
+                            else:
+                                dist = tss - sta
 
-                # when strand of gene is plus
-                if('+' == x['strand']) and \
-                        (sta <= (x['sta'] + indist)) and \
-                        ((x['sta'] - updist) <= end):
-                    gene2peaks[x['gene']][peakfile]['flag'] = 1
+                            prev_dist = dists[g]
+                            if(prev_dist == DEFAULT_VALUE) or \
+                              (prev_dist > dist):
+                                dists[g] = dist
 
-                    # 20150303
-                    dist = 0
-                    if sta < x['sta']:
-                      dist = x['sta'] - end
-                    else:
-                      dist = x['sta'] - sta
-
-                    if(prev_dist == DEFAULT_VALUE) or \
-                      (prev_dist > dist):
-                        gene2peaks[x['gene']][peakfile]['dist'] = dist
-
-                # strand of gene is minus
-                elif('-' == x['strand']) and \
-                        (sta <= (x['end'] + updist)) and \
-                        ((x['end'] - indist) <= end):
-                    gene2peaks[x['gene']][peakfile]['flag'] = 1
-
-                    # 20150303
-                    dist = 0
-                    if (x['end'] < end):
-                      dist = sta - x['end']
-                    else:
-                      dist = end - x['end']
+                    # strand of gene is minus
+                    elif MINUS == x.strand:
+                        tss = x.end
+                        if (sta <= (tss + updist)) and \
+                           ((tss - indist) <= end):
+                            g = x.gene
+                            flags[g] = 1
+                            if counting:
+                                nhits += 1
 
-                    if(DEFAULT_VALUE == prev_dist) or \
-                      (prev_dist > dist):
-                        gene2peaks[x['gene']][peakfile]['dist'] = dist
-    r_file.close()
-    if count - ecount <= 0:
-        print('Error: No valid line in ' + peakfile, file=sys.stderr)
-        sys.exit()
+                            # 20150303
+                            if tss < end:
+                                dist = sta - tss
+                            else:
+                                dist = end - tss
+
+                            prev_dist = dists[g]
+                            if(DEFAULT_VALUE == prev_dist) or \
+                              (prev_dist > dist):
+                                dists[g] = dist
+            if counting:
+                bucket = sizeBucket(ncand - cand)
+                perPeak[bucket] = perPeak.get(bucket, 0) + 1
+
+    if counting:
+        stats.update(indexStats(bin2genes, chroms, lookups))
+        stats.update({
+            'peaks': npeaks, 'peaks_unknown_chrom': unknown,
+            'bins_looked_up': nbins, 'bins_with_records': sum(
+                lookups.values()),
+            'candidates_scanned': ncand,
+            'candidates_per_peak': perPeak,
+            'window_hits': nhits, 'window_rejects': ncand - nhits})
+
+
+def writeSharedIndex(indexFile, bin2genes):
+    """Write the bin index as flat arrays for worker processes.
+
+    The records of bin2genes are laid out sorted by bin key: keys holds
+    the distinct keys, the records of keys[i] are offsets[i] to
+    offsets[i + 1] - 1 of the record arrays (sta, end, gene index,
+    strand code). Workers memory-map the file with mapSharedIndex, so
+    the pages are shared instead of a copy of bin2genes per process.
+
+    Keyword arguments:
+    indexFile -- Output file
+    bin2genes -- Dictionary of bin to genes
+    Returns: None
+
+    """
+    keys = array('l', sorted(bin2genes))
+    offsets = array('l', [0])
+    stas = array('l')
+    ends = array('l')
+    genes = array('l')
+    strands = array('b')
+    for key in keys:
+        for x in bin2genes[key]:
+            stas.append(x.sta)
+            ends.append(x.end)
+            genes.append(x.gene)
+            strands.append(x.strand)
+        offsets.append(len(stas))
+    with open(indexFile, 'wb') as findex:
+        findex.write(SHARED_HEADER.pack(len(keys), len(stas)))
+        for column in (keys, offsets, stas, ends, genes, strands):
+            column.tofile(findex)
+
+
+def mapSharedIndex(indexFile):
+    """Memory-map an index written by writeSharedIndex.
+
+    Keyword arguments:
+    indexFile -- Index file
+    Returns: Tuple of memoryviews (keys, offsets, stas, ends, genes,
+             strands), arrays on Python 2 (see mapColumn)
+
+    """
+    with open(indexFile, 'rb') as findex:
+        data = mmap.mmap(findex.fileno(), 0, access=mmap.ACCESS_READ)
+    nkeys, nrecs = SHARED_HEADER.unpack(data[:SHARED_HEADER.size])
+    views = []
+    pos = SHARED_HEADER.size
+    for n, typecode in ((nkeys, 'l'), (nkeys + 1, 'l'), (nrecs, 'l'),
+                        (nrecs, 'l'), (nrecs, 'l'), (nrecs, 'b')):
+        views.append(mapColumn(data, pos, typecode, n))
+        pos += n * array(typecode).itemsize
+    return tuple(views)
 
-    return gene2peaks
+
+def boundedMap(pool, func, jobs, depth):
+    """Run jobs in a pool with a bounded number of jobs in flight.
+
+    Unlike pool.imap, a job is only submitted once the result of the job
+    depth places before it has been taken, so finished columns waiting
+    for the caller stay bounded.
+
+    Keyword arguments:
+    pool -- multiprocessing.Pool
+    func -- Function run on each job
+    jobs -- List of jobs
+    depth -- Number of jobs in flight
+    Returns: Generator of results, in job order
+
+    """
+    running = deque()
+    for job in jobs:
+        running.append(pool.apply_async(func, (job,)))
+        if len(running) >= depth:
+            yield running.popleft().get()
+    while running:
+        yield running.popleft().get()
+
+
+def attachSharedIndex(indexFile):
+    """Pool initializer attaching a worker to the shared index."""
+    global sharedIndex
+    sharedIndex = mapSharedIndex(indexFile)
+
+
+def scanPeakFile(job):
+    """Compute the columns of a peak file in a worker process.
+
+    Same lookup as readPeakFile on the index attached by
+    attachSharedIndex.
+
+    Keyword arguments:
+    job -- (peakFile, chroms, ngenes, updist, indist, sco_threshold,
+           macs_flg, mergeInput, validate)
+    Returns: Flag column, distance column, line counts, number of merged
+             peaks, or None if the peak file is malformed
+
+    """
+    peakFile, chroms, ngenes, updist, indist, sco_threshold, macs_flg, \
+        mergeInput, validate = job
+    keys, offsets, stas, ends, genes, strands = sharedIndex
+    nkeys = len(keys)
+    flags = array('b', [0]) * ngenes
+    dists = array('l', [DEFAULT_VALUE]) * ngenes
+    metrics = Metrics()
+    stage = {}
+    try:
+        chunks = parsePeakFile(peakFile, sco_threshold, macs_flg,
+                               metrics=metrics, validate=validate)
+        if mergeInput:
+            chunks = mergePeaks(chunks, stage=stage)
+        for chunk in chunks:
+            for chrom, sta, end in chunk:
+                if chrom not in chroms:
+                    continue
+                chromKey = chroms[chrom] << BIN_BITS
+                upperBins, lowerBins = binFromRangeStandard(sta, end)
+                for val in upperBins + lowerBins:
+                    key = chromKey | val
+                    i = bisect.bisect_left(keys, key)
+                    if i == nkeys or keys[i] != key:
+                        continue
+                    for r in range(offsets[i], offsets[i + 1]):
+                        strand = strands[r]
+                        if PLUS == strand:
+                            tss = stas[r]
+                            if sta > tss + indist or tss - updist > end:
+                                continue
+                            if sta < tss:
+                                dist = tss - end
+                            else:
+                                dist = tss - sta
+                        elif MINUS == strand:
+                            tss = ends[r]
+                            if sta > tss + updist or tss - indist > end:
+                                continue
+                            if tss < end:
+                                dist = sta - tss
+                            else:
+                                dist = end - tss
+                        else:
+                            continue
+                        g = genes[r]
+                        flags[g] = 1
+                        prev_dist = dists[g]
+                        if(prev_dist == DEFAULT_VALUE) or (prev_dist > dist):
+                            dists[g] = dist
+    except SystemExit:
+        # the error is printed already, the main process exits
+        return None
+    return flags, dists, metrics.inputs.get(peakFile, {}), \
+        stage.get('merged_peaks')
+
+
+def binWindows(bin2genes, updist, indist):
+    """Re-bin gene records by their tss windows.
+
+    readGeneFile bins a record by its own span, so a peak in the window
+    of a gene but in another bin than the record is never compared; the
+    wider the window, the more such peaks are missed. Here every record
+    is binned by its window, [tss - updist, tss + indist] on the plus
+    strand and [tss - indist, tss + updist] on the minus strand, widened
+    by one position on each side since the window test of readPeakFile
+    includes both ends, so a peak lookup finds every window it overlaps.
+    Records of other strands are never hit and are dropped.
+
+    Keyword arguments:
+    bin2genes -- Dictionary of bin to genes
+    updist -- Distance upstream from tss
+    indist -- Distance downstream from tss
+    Returns: Dictionary of bin to genes, keyed like bin2genes
+
+    """
+    bin2windows = {}
+    for key, records in bin2genes.items():
+        chromKey = key & ~((1 << BIN_BITS) - 1)
+        for x in records:
+            if PLUS == x.strand:
+                sta = x.sta - updist
+                end = x.sta + indist
+            elif MINUS == x.strand:
+                sta = x.end - indist
+                end = x.end + updist
+            else:
+                continue
+            upperBins, lowerBins = binFromRangeStandard(max(0, sta - 1),
+                                                        end + 1)
+            bin2windows.setdefault(chromKey | upperBins[0], []).append(x)
+    return bin2windows
+
+
+def sortWindows(bin2genes, updist, indist):
+    """Sort the tss windows of gene records per chromosome.
+
+    The window of a record is [tss - updist, tss + indist] on the plus
+    strand and [tss - indist, tss + updist] on the minus strand. All
+    windows have the same length, so sorting them by start also sorts
+    them by end.
+
+    Keyword arguments:
+    bin2genes -- Dictionary of bin to genes
+    updist -- Distance upstream from tss
+    indist -- Distance downstream from tss
+    Returns: Dictionary of chromosome code to (window starts, records)
+
+    """
+    chrom2windows = {}
+    for tmp in bin2genes.values():
+        for x in tmp:
+            if PLUS == x.strand:
+                wsta = x.sta - updist
+            elif MINUS == x.strand:
+                wsta = x.end - indist
+            else:
+                continue
+            chrom2windows.setdefault(x.chrom, []).append((wsta, x))
+    windows = {}
+    for code, pairs in chrom2windows.items():
+        pairs.sort(key=lambda pair: pair[0])
+        windows[code] = ([pair[0] for pair in pairs],
+                         [pair[1] for pair in pairs])
+    return windows
+
+
+def hitGene(x, sta, end, flags, dists):
+    """Set flag & distance of a gene whose tss window overlaps a peak.
+
+    Keyword arguments:
+    x -- GeneRecord
+    sta -- Start position of the peak
+    end -- End position of the peak
+    flags -- Flag column indexed by gene
+    dists -- Distance column indexed by gene
+    Returns: None
+
+    """
+    if PLUS == x.strand:
+        tss = x.sta
+        if sta < tss:
+            dist = tss - end
+        else:
+            dist = tss - sta
+    else:
+        tss = x.end
+        if tss < end:
+            dist = sta - tss
+        else:
+            dist = end - tss
+    g = x.gene
+    flags[g] = 1
+    prev_dist = dists[g]
+    if(prev_dist == DEFAULT_VALUE) or (prev_dist > dist):
+        dists[g] = dist
+
+
+def sweepPeakFile(chunks, chroms, windows, flags, dists, updist, indist,
+                  state=None):
+    """Set flag & distance of each gene from sorted peaks.
+
+    Merge join of peaks sorted by start (checked by parsePeakFile) with
+    the tss windows of their chromosome. Windows ending before the
+    current peak never overlap a later one, so the windows overlapping
+    the current peak start at a position lo that only moves forward.
+
+    Keyword arguments:
+    chunks -- Chunks of sorted (chrom, sta, end)
+    chroms -- Dictionary of chromosome to chromosome code
+    windows -- Windows returned by sortWindows
+    flags -- Flag column indexed by gene
+    dists -- Distance column indexed by gene
+    updist -- Distance upstream from tss
+    indist -- Distance downstream from tss
+    state -- List [chromosome, lo] carried from the call on the previous
+             chunks of the same file, so a file can be swept chunk by
+             chunk; None starts a new file
+    Returns: None
+
+    """
+    span = updist + indist
+    if state is None:
+        state = [None, 0]
+    prev_chrom, lo = state
+    wstarts, records = windows.get(chroms.get(prev_chrom), ([], []))
+    for chunk in chunks:
+        for chrom, sta, end in chunk:
+            if chrom != prev_chrom:
+                prev_chrom = chrom
+                wstarts, records = windows.get(chroms.get(chrom), ([], []))
+                lo = 0
+            while lo < len(wstarts) and wstarts[lo] + span < sta:
+                lo += 1
+            i = lo
+            while i < len(wstarts) and wstarts[i] <= end:
+                hitGene(records[i], sta, end, flags, dists)
+                i += 1
+    state[0] = prev_chrom
+    state[1] = lo
+
+
+def summitPeakFile(chunks, chroms, windows, flags, dists, updist, indist):
+    """Set flag & distance of each gene from peak summits.
+
+    A summit is a position rather than a peak edge: its distance is the
+    signed number of positions from the summit to the tss, positive
+    upstream, where the tss is the first base of the gene on its strand
+    (0-based end - 1 on the minus strand). A gene is hit when the summit
+    is at most updist upstream and indist downstream. The candidates are
+    the windows starting in [sta - updist - indist, sta + 1], found by
+    bisecting the sorted window starts of sortWindows, so the peaks need
+    not be sorted.
+
+    Keyword arguments:
+    chunks -- Chunks of (chrom, sta, end) read with summit
+    chroms -- Dictionary of chromosome to chromosome code
+    windows -- Windows returned by sortWindows
+    flags -- Flag column indexed by gene
+    dists -- Distance column indexed by gene
+    updist -- Distance upstream from tss
+    indist -- Distance downstream from tss
+    Returns: None
+
+    """
+    span = updist + indist
+    for chunk in chunks:
+        for chrom, sta, end in chunk:
+            code = chroms.get(chrom)
+            if code not in windows:
+                continue
+            wstarts, records = windows[code]
+            for i in range(bisect.bisect_left(wstarts, sta - span),
+                           bisect.bisect_right(wstarts, sta + 1)):
+                x = records[i]
+                if PLUS == x.strand:
+                    dist = x.sta - sta
+                else:
+                    dist = sta - (x.end - 1)
+                if dist < -indist or updist < dist:
+                    continue
+                g = x.gene
+                flags[g] = 1
+                prev_dist = dists[g]
+                if(prev_dist == DEFAULT_VALUE) or (prev_dist > dist):
+                    dists[g] = dist
+
+
+def mergePeaks(chunks, sortedInput=False, stage=None):
+    """Drop duplicate peaks before the overlap search.
+
+    Peaks passed the score threshold already, so the duplicates of a peak
+    only repeat its lookups. Only identical intervals are merged: for a
+    gene, the distance of a peak containing another one is not always
+    smaller, so merging overlapping peaks would change the distances.
+    With sorted input only the peaks sharing the current start are kept
+    in memory.
+
+    Keyword arguments:
+    chunks -- Chunks of (chrom, sta, end)
+    sortedInput -- True if the peaks are sorted by chromosome and start
+    stage -- Metrics stage receiving the number of merged peaks
+    Returns: Generator of lists of (chrom, sta, end)
+
+    """
+    seen = set()
+    merged = 0
+    prev = None
+    for chunk in chunks:
+        unique = []
+        for peak in chunk:
+            if sortedInput and peak[:2] != prev:
+                seen.clear()
+                prev = peak[:2]
+            if peak in seen:
+                merged += 1
+                continue
+            seen.add(peak)
+            unique.append(peak)
+        yield unique
+    if stage is not None:
+        stage['merged_peaks'] = merged
+
+
+def sortPeaks(chunks, chroms):
+    """Sort peaks per chromosome for nearest-peak search.
+
+    Duplicate peaks are dropped: findNearest takes k peaks on each side
+    and nearestPeaks reports distinct peaks, so a duplicate would push
+    one of the k nearest peaks out.
+
+    Keyword arguments:
+    chunks -- Chunks of (chrom, sta, end)
+    chroms -- Dictionary of chromosome to chromosome code
+    Returns: Dictionary of chromosome code to (starts, ends of the peaks
+             sorted by start, starts, ends of the peaks sorted by end,
+             longest peak)
+
+    """
+    chrom2peaks = {}
+    for chunk in chunks:
+        for chrom, sta, end in chunk:
+            if chrom in chroms:
+                chrom2peaks.setdefault(chroms[chrom], []).append((sta, end))
+    sortedPeaks = {}
+    for code, peaks in chrom2peaks.items():
+        peaks = sorted(set(peaks))
+        byEnd = sorted(peaks, key=lambda x: x[1])
+        sortedPeaks[code] = ([x[0] for x in peaks], [x[1] for x in peaks],
+                             [x[0] for x in byEnd], [x[1] for x in byEnd],
+                             max([x[1] - x[0] for x in peaks]))
+    return sortedPeaks
+
+
+def findNearest(sortedPeaks, tss, k):
+    """Find candidates of the k nearest peaks to a position.
+
+    Returns the k nearest peaks ending at or before tss, the k nearest
+    starting after it and all peaks overlapping it, so the k nearest
+    peaks are among them.
+
+    Keyword arguments:
+    sortedPeaks -- Peaks of the chromosome returned by sortPeaks
+    tss -- Position
+    k -- Number of peaks
+    Returns: List of (gap, sta, end)
+
+    """
+    starts, ends, eStarts, eEnds, maxLen = sortedPeaks
+    found = []
+    i = bisect.bisect_right(eEnds, tss)
+    for j in range(max(0, i - k), i):
+        found.append((tss - eEnds[j], eStarts[j], eEnds[j]))
+    i = bisect.bisect_right(starts, tss)
+    for j in range(i, min(len(starts), i + k)):
+        found.append((starts[j] - tss, starts[j], ends[j]))
+    # overlapping peaks start at most maxLen before tss
+    j = i - 1
+    while j >= 0 and tss - maxLen <= starts[j]:
+        if tss < ends[j]:
+            found.append((0, starts[j], ends[j]))
+        j -= 1
+    return found
+
+
+def nearestPeaks(bin2genes, ngenes, sortedPeaks, k, summit=False):
+    """Report the signed distances to the k nearest peaks of each gene.
+
+    Distances are signed as in readPeakFile and ordered from the nearest
+    peak, at any distance from the tss. With summit, the peaks are
+    summits and the distances are point distances as in summitPeakFile.
+
+    Keyword arguments:
+    bin2genes -- Dictionary of bin to genes
+    ngenes -- Number of genes
+    sortedPeaks -- Peaks returned by sortPeaks
+    k -- Number of peaks
+    summit -- True if the peaks were read with summit
+    Returns: List of distances listed in semicolons, indexed by gene
+
+    """
+    gene2near = [None] * ngenes
+    for tmp in bin2genes.values():
+        for x in tmp:
+            if x.chrom not in sortedPeaks:
+                continue
+            if PLUS == x.strand:
+                tss = x.sta
+            elif MINUS == x.strand:
+                tss = x.end - 1 if summit else x.end
+            else:
+                continue
+            near = gene2near[x.gene]
+            if near is None:
+                near = {}
+                gene2near[x.gene] = near
+            for gap, sta, end in findNearest(sortedPeaks[x.chrom], tss, k):
+                if summit:
+                    dist = tss - sta if PLUS == x.strand else sta - tss
+                    gap = abs(dist)
+                elif PLUS == x.strand:
+                    if sta < tss:
+                        dist = tss - end
+                    else:
+                        dist = tss - sta
+                elif tss < end:
+                    dist = sta - tss
+                else:
+                    dist = end - tss
+                if (sta, end) not in near or near[(sta, end)][0] > gap:
+                    near[(sta, end)] = (gap, dist)
+
+    cells = []
+    for near in gene2near:
+        if not near:
+            cells.append('-')
+            continue
+        best = sorted([(gap, peak, dist)
+                       for peak, (gap, dist) in near.items()])[:k]
+        cells.append(';'.join([str(x[2]) for x in best]))
+    return cells
 
 
 def main():
@@ -283,7 +1076,7 @@ def main():
         outFile = ''
         labelStr = ''
         flg = 0
-        op_part = re.compile('^-')
+        op_part = re.compile('^-.') # a lone '-' is the standard input
 
         for p in range(len(sys.argv)):
             if sys.argv[p] in ('-p', '--peak'):
@@ -305,19 +1098,22 @@ def main():
         parser.add_option(
             '-p', '--peak', action='store', dest='arg_peak',
             default='', nargs=n,
-            help='Peak files listed in spaces')
+            help='Peak files listed in spaces(- reads the standard input)')
         parser.add_option(
             '-g', '--gene', action='store', dest='arg_gene',
             default='',
-            help='Gene file in gtf/gff3 format')
+            help='Gene file in gtf/gff3 format(several listed in commas ' + \
+                 'are computed in one pass over the peak files)')
         parser.add_option(
             '-d', '--dist', action='store', dest='arg_dist',
             default='',
-            help='Output file (distance)')
+            help='Output file (distance, .gz/.xz compressed by extension, ' + \
+                 'one per gene file listed in commas)')
         parser.add_option(
             '-o', '--out', action='store', dest='arg_out',
             default='',
-            help='Output file (existance)')
+            help='Output file (existance, .gz/.xz compressed by extension, ' + \
+                 'one per gene file listed in commas)')
         parser.add_option(
             '-u', '--up', action='store', dest='arg_up', type='int',
             default=UPDIST_DEFAULT,
@@ -337,6 +1133,78 @@ def main():
             dest='macs2',
             default=False,
             help='Use this option when the peak files are generated with MACS2.')
+        parser.add_option(
+            '--summit', action='store_true', dest='arg_summit',
+            default=False,
+            help='Use the summits of MACS2 narrowPeak records instead of ' + \
+                 'the peaks(with --macs2)')
+        parser.add_option(
+            '--prefetch', action='store', dest='arg_prefetch', type='int',
+            default=PREFETCH_DEFAULT,
+            help='Number of threads reading peak files ahead(0 reads inline)')
+        parser.add_option(
+            '--npy', action='store', dest='arg_npy',
+            default='',
+            help='Output prefix of flag and distance matrices in .npy format')
+        parser.add_option(
+            '--memory', action='store', dest='arg_memory', type='float',
+            default=MEMORY_DEFAULT,
+            help='Memory budget(MB) for flag and distance columns, ' + \
+                 'larger panels are processed in blocks spilled to disk')
+        parser.add_option(
+            '--nearest', action='store', dest='arg_nearest', type='int',
+            default=NEAREST_DEFAULT,
+            help='Number of nearest peaks reported per gene at any distance')
+        parser.add_option(
+            '--near', action='store', dest='arg_near',
+            default='',
+            help='Output file (nearest peaks)')
+        parser.add_option(
+            '--sorted', action='store_true', dest='arg_sorted',
+            default=False,
+            help='Peak files are sorted by chromosome and start position')
+        parser.add_option(
+            '--merge-peaks', action='store_true', dest='arg_merge',
+            default=False,
+            help='Merge duplicate peaks before the overlap search')
+        parser.add_option(
+            '--work-dir', action='store', dest='arg_work_dir',
+            default='',
+            help='Directory checkpointing finished peak files to resume ' + \
+                 'an interrupted run')
+        parser.add_option(
+            '--workers', action='store', dest='arg_workers', type='int',
+            default=WORKERS_DEFAULT,
+            help='Number of processes computing peak files with a ' + \
+                 'shared gene index(not with --sorted or --nearest)')
+        parser.add_option(
+            '--lazy-annotation', action='store_true', dest='arg_lazy',
+            default=False,
+            help='Load only the chromosomes of the peak files through a ' + \
+                 'sidecar index of the gene file(' + CHROM_INDEX_SUFFIX + ')')
+        parser.add_option(
+            '--validate', action='store', dest='arg_validate',
+            default=VALIDATE_DEFAULT,
+            help='Numeric field checks: full(every line), sample(a ' + \
+                 'prefix and a random sample) or none')
+        parser.add_option(
+            '--index-stats', action='store_true', dest='arg_index_stats',
+            default=False,
+            help='Count bin index lookups per peak file(candidates, ' + \
+                 'window hits, bin occupancy, largest bins)')
+        parser.add_option(
+            '--metrics-json', action='store', dest='arg_metrics',
+            default='',
+            help='Output file of run metrics in JSON')
+        parser.add_option(
+            '--gene-workers', action='store', dest='arg_gene_workers',
+            type='int', default=GENE_WORKERS_DEFAULT,
+            help='Number of processes parsing the gene file')
+        parser.add_option(
+            '--gene-format', action='store', dest='arg_gene_format',
+            default=None,
+            help='Format of the gene file(gtf or gff3), by default ' + \
+                 'from its extension')
 
         (opt, args) = parser.parse_args()
         arg = opt.__dict__
@@ -347,30 +1215,420 @@ def main():
         updist = arg['arg_up']
         indist = arg['arg_in']
         labelStr = arg['arg_label']
+        prefetch = arg['arg_prefetch']
+        npyPrefix = arg['arg_npy']
+        memory = arg['arg_memory']
+        nearest = arg['arg_nearest']
+        nearFile = arg['arg_near']
+        sortedInput = arg['arg_sorted']
+        geneWorkers = arg['arg_gene_workers']
+        mergeInput = arg['arg_merge']
+        workDir = arg['arg_work_dir']
+        workers = arg['arg_workers']
+        lazyAnnotation = arg['arg_lazy']
+        validate = arg['arg_validate']
+        countIndex = arg['arg_index_stats']
+        metricsJson = arg['arg_metrics']
+        geneFormat = arg['arg_gene_format']
+        summit = arg['arg_summit']
         if '' in (geneFile, outFile, distFile):
             raise TypeError()
 
+        # several gene files run check_peak_batch, which keeps every
+        # column in memory and has no worker processes nor checkpoints
+        geneFiles = geneFile.split(',')
+        outFiles = outFile.split(',')
+        distFiles = distFile.split(',')
+        if len(outFiles) != len(geneFiles) or \
+           len(distFiles) != len(geneFiles):
+            raise TypeError()
+        if len(geneFiles) > 1 and ('' != npyPrefix or 0 < memory or
+                                   0 < nearest or '' != workDir or
+                                   workers > 1 or countIndex):
+            raise TypeError()
+
         if 0 == len(peakFiles):
             raise TypeError()
 
         if updist <= 0 or indist <= 0:
             raise TypeError()
 
+        if prefetch < 0 or memory < 0 or nearest < 0 or geneWorkers < 1:
+            raise TypeError()
+
+        if (0 < nearest) != ('' != nearFile):
+            raise TypeError()
+
+        if workers < 1 or (workers > 1 and (sortedInput or 0 < nearest or
+                                            summit)):
+            raise TypeError()
+
+        if validate not in VALIDATE_LEVELS:
+            raise TypeError()
+
+        if summit and not arg['macs2']:
+            raise TypeError()
+
+        if geneFormat not in (None,) + GENE_FORMATS:
+            raise TypeError()
+
         if str is type(peakFiles):
             peakFiles = [peakFiles]
         else:
             peakFiles = list(peakFiles)
     except:
         print('Usage: ' + str(sys.argv[0]) + \
-              ' --gene genes.gtf --peak peakFile [peakFile2 peakFile3 ...] --out out_peak.txt --dist out_dist.txt [--up ' + \
+              ' --gene genes.gtf[,genes2.gtf ...] --peak peakFile [peakFile2 peakFile3 ...] --out out_peak.txt[,...] --dist out_dist.txt[,...] [--up ' + \
               str(UPDIST_DEFAULT) + '] [--in ' + \
-              str(INDIST_DEFAULT) + ']  [--label TF1,TF2, ...] [--macs2]')
+              str(INDIST_DEFAULT) + ']  [--label TF1,TF2, ...] [--macs2 [--summit]]' + \
+              ' [--prefetch ' + str(PREFETCH_DEFAULT) + '] [--npy prefix]' + \
+              ' [--memory MB] [--nearest k --near out_nearest.txt] [--sorted]' + \
+              ' [--merge-peaks] [--work-dir dir] [--workers ' + \
+              str(WORKERS_DEFAULT) + '] [--lazy-annotation]' + \
+              ' [--validate full|sample|none] [--index-stats]' + \
+              ' [--metrics-json metrics.json]' + \
+              ' [--gene-workers ' + str(GENE_WORKERS_DEFAULT) + ']' + \
+              ' [--gene-format gtf|gff3]')
         sys.exit()
-    check_peak(genefile, peakfiles, tmpoutpeak,
-        outdist, updist, indist, labelStr, sco_threshold, arg['macs2'])
+    metrics = Metrics()
+    if len(geneFiles) > 1:
+        check_peak_batch(geneFiles, peakFiles, outFiles, distFiles, updist,
+            indist, labelStr, sco_threshold, arg['macs2'], prefetch,
+            sortedInput, metrics, geneWorkers, mergeInput, lazyAnnotation,
+            validate, geneFormat, summit)
+    else:
+        check_peak(geneFile, peakFiles, outFile,
+            distFile, updist, indist, labelStr, sco_threshold, arg['macs2'],
+            prefetch, npyPrefix, memory, nearest, nearFile, sortedInput,
+            geneWorkers=geneWorkers, mergeInput=mergeInput, workDir=workDir,
+            workers=workers, lazyAnnotation=lazyAnnotation,
+            validate=validate, countIndex=countIndex, metrics=metrics,
+            geneFormat=geneFormat, summit=summit)
+    if '' != metricsJson:
+        metrics.write(metricsJson)
 
-def check_peak(geneFile, peakFiles, outFile, distFile,
-    updist, indist, labelStr, sco_threshold, macs2):
+def openNpy(npyFile, typecode, nrow, ncol):
+    """Create a .npy file and write its header.
+
+    The matrix is stored in Fortran order, so every column is contiguous,
+    columns can be appended one after another with appendColumns and the
+    file can be memory-mapped with numpy.load(mmap_mode='r').
+
+    Keyword arguments:
+    npyFile -- Output file
+    typecode -- array typecode of the matrix
+    nrow -- Number of rows
+    ncol -- Number of columns
+    Returns: File object
+
+    """
+    itemsize = array(typecode).itemsize
+    if 1 == itemsize:
+        descr = '|i1'
+    elif 'little' == sys.byteorder:
+        descr = '<i%d' % itemsize
+    else:
+        descr = '>i%d' % itemsize
+    header = "{'descr': '%s', 'fortran_order': True, 'shape': (%d, %d), }" % (
+        descr, nrow, ncol)
+    # pad so that the data starts on a 64 byte boundary
+    pad = 64 - (len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = header + ' ' * pad + '\n'
+    fnpy = open(npyFile, 'wb')
+    fnpy.write(NPY_MAGIC)
+    fnpy.write(struct.pack('<H', len(header)))
+    fnpy.write(header.encode('latin1'))
+    return fnpy
+
+
+def appendColumns(fnpy, columns, order):
+    """Append columns to a .npy file created by openNpy.
+
+    Keyword arguments:
+    fnpy -- File object returned by openNpy
+    columns -- List of arrays
+    order -- Row order as indexes into the columns
+    Returns: None
+
+    """
+    for column in columns:
+        array(column.typecode, [column[g] for g in order]).tofile(fnpy)
+
+
+def mapNpy(npyFile):
+    """Memory-map a matrix written by openNpy and appendColumns.
+
+    Keyword arguments:
+    npyFile -- .npy file
+    Returns: memoryview, Tuple
+
+    """
+    with open(npyFile, 'rb') as fnpy:
+        magic = fnpy.read(len(NPY_MAGIC))
+        if magic != NPY_MAGIC:
+            print('Error: Unknown format of ' + npyFile, file=sys.stderr)
+            sys.exit()
+        size = struct.unpack('<H', fnpy.read(2))[0]
+        header = ast.literal_eval(fnpy.read(size).decode('latin1'))
+        if not header['fortran_order'] or \
+           header['descr'][1:] not in ('i1', 'i%d' % array('l').itemsize):
+            print('Error: Unknown format of ' + npyFile, file=sys.stderr)
+            sys.exit()
+        shape = header['shape']
+        typecode = 'b' if 'i1' == header['descr'][1:] else 'l'
+        if 0 == shape[0] * shape[1]:
+            return array(typecode), shape
+        data = mmap.mmap(fnpy.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapColumn(data, len(NPY_MAGIC) + 2 + size, typecode,
+                     shape[0] * shape[1]), shape
+
+
+def mapColumn(data, pos, typecode, n):
+    """View a column of a memory-mapped file as an array.
+
+    Python 2 has no memoryview.cast, so the column is copied into an
+    array there instead.
+
+    Keyword arguments:
+    data -- mmap
+    pos -- Byte offset of the column
+    typecode -- array typecode of the column
+    n -- Number of items
+    Returns: memoryview or array
+
+    """
+    size = n * array(typecode).itemsize
+    try:
+        return memoryview(data)[pos:pos + size].cast(typecode)
+    except (TypeError, AttributeError):
+        column = array(typecode)
+        column.fromstring(data[pos:pos + size])
+        return column
+
+
+def openBinary(prefix, genes, order, peakLabels):
+    """Create the .npy files of flag and distance matrices.
+
+    Creates prefix_flag.npy and prefix_dist.npy (genes x peak files, no
+    peak is DEFAULT_VALUE in the distances) and writes the gene and label
+    index to prefix_genes.txt and prefix_labels.txt, one name per line.
+    The columns are appended with appendColumns.
+
+    Keyword arguments:
+    prefix -- Output prefix
+    genes -- List of genes
+    order -- Row order as indexes into genes
+    peakLabels -- List of peak labels
+    Returns: File object, File object
+
+    """
+    with open(prefix + NPY_GENE_SUFFIX, 'w') as fgene:
+        for g in order:
+            fgene.write(genes[g] + '\n')
+    with open(prefix + NPY_LABEL_SUFFIX, 'w') as flabel:
+        for peakLabel in peakLabels:
+            flabel.write(peakLabel + '\n')
+    return (openNpy(prefix + NPY_FLAG_SUFFIX, 'b', len(order), len(peakLabels)),
+            openNpy(prefix + NPY_DIST_SUFFIX, 'l', len(order), len(peakLabels)))
+
+
+def writeRows(fout, fdist, order, flags, dists, genes=None):
+    """Write flag and distance columns row by row.
+
+    Keyword arguments:
+    fout -- Output file (existance)
+    fdist -- Output file (distance)
+    order -- Row order as indexes into the columns
+    flags -- List of flag columns
+    dists -- List of distance columns
+    genes -- List of genes, None writes the values only
+    Returns: None
+
+    """
+    for g in order:
+        if genes is not None:
+            fout.write(genes[g])
+            fdist.write(genes[g])
+
+        for col in range(len(flags)):
+            fout.write(',' + str(flags[col][g]))
+            dist = dists[col][g]
+            if DEFAULT_VALUE == dist:
+                dist = '-'
+            fdist.write(',' + str(dist))
+        fout.write('\n')
+        fdist.write('\n')
+
+
+def spillBlock(spillDir, block, order, flags, dists):
+    """Write a block of columns to spill files.
+
+    Keyword arguments:
+    spillDir -- Directory of spill files
+    block -- Block number
+    order -- Row order as indexes into the columns
+    flags -- List of flag columns
+    dists -- List of distance columns
+    Returns: Tuple of spill files (existance, distance)
+
+    """
+    spill = (os.path.join(spillDir, 'block%d_peak.txt' % block),
+             os.path.join(spillDir, 'block%d_dist.txt' % block))
+    with open(spill[0], 'w') as fout, open(spill[1], 'w') as fdist:
+        writeRows(fout, fdist, order, flags, dists)
+    return spill
+
+
+def joinSpills(spillDir, name, spills):
+    """Join spill files of consecutive blocks row by row into one spill.
+
+    The joined spill files are removed.
+
+    Keyword arguments:
+    spillDir -- Directory of spill files
+    name -- Name of the joined spill
+    spills -- List of spill files returned by spillBlock
+    Returns: Tuple of spill files (existance, distance)
+
+    """
+    joined = (os.path.join(spillDir, name + '_peak.txt'),
+              os.path.join(spillDir, name + '_dist.txt'))
+    for i in range(2):
+        fblocks = [open(spill[i], 'r') for spill in spills]
+        with open(joined[i], 'w') as fjoin:
+            for line in fblocks[0]:
+                fjoin.write(line.rstrip('\n'))
+                for fblock in fblocks[1:]:
+                    fjoin.write(fblock.readline().rstrip('\n'))
+                fjoin.write('\n')
+        for fblock in fblocks:
+            fblock.close()
+            os.remove(fblock.name)
+    return joined
+
+
+def mergeBlocks(fout, fdist, genes, order, spills, spillDir):
+    """Join spill files of column blocks row by row.
+
+    More than MERGE_FANIN blocks are first joined in groups of
+    MERGE_FANIN, so the number of open files stays bounded.
+
+    Keyword arguments:
+    fout -- Output file (existance)
+    fdist -- Output file (distance)
+    genes -- List of genes
+    order -- Row order as indexes into genes
+    spills -- List of spill files returned by spillBlock
+    spillDir -- Directory of spill files
+    Returns: None
+
+    """
+    level = 0
+    while len(spills) > MERGE_FANIN:
+        spills = [joinSpills(spillDir, 'join%d_%d' % (level, i),
+                             spills[i:i + MERGE_FANIN])
+                  for i in range(0, len(spills), MERGE_FANIN)]
+        level += 1
+    fpeaks = [open(spill[0], 'r') for spill in spills]
+    fdists = [open(spill[1], 'r') for spill in spills]
+    for g in order:
+        fout.write(genes[g])
+        for fpeak in fpeaks:
+            fout.write(fpeak.readline().rstrip('\n'))
+        fout.write('\n')
+        fdist.write(genes[g])
+        for fblock in fdists:
+            fdist.write(fblock.readline().rstrip('\n'))
+        fdist.write('\n')
+    for fblock in fpeaks + fdists:
+        fblock.close()
+
+
+def readBinaryDist(distFile):
+    """Read the distance matrix written with openBinary.
+
+    Keyword arguments:
+    distFile -- prefix_dist.npy file
+    Returns: List, Generator of (gene, list of distances)
+
+    """
+    prefix = distFile[:-len(NPY_DIST_SUFFIX)]
+    with open(prefix + NPY_LABEL_SUFFIX, 'r') as flabel:
+        peakLabels = [line.rstrip('\r\n') for line in flabel]
+    matrix, shape = mapNpy(distFile)
+    if len(peakLabels) != shape[1]:
+        print('Error: Number of labels in ' + prefix + NPY_LABEL_SUFFIX + \
+              ' does not match ' + distFile, file=sys.stderr)
+        sys.exit()
+
+    def rows():
+        nrow = shape[0]
+        with open(prefix + NPY_GENE_SUFFIX, 'r') as fgene:
+            for g, line in enumerate(fgene):
+                values = []
+                for col in range(shape[1]):
+                    dist = matrix[col * nrow + g]
+                    if DEFAULT_VALUE == dist:
+                        dist = '-'
+                    values.append(str(dist))
+                yield line.rstrip('\r\n'), values
+
+    return peakLabels, rows()
+
+
+def saveColumn(path, flags, dists, nears=None):
+    """Checkpoint the flag and distance columns of a peak file.
+
+    Keyword arguments:
+    path -- Checkpoint file
+    flags -- Flag column
+    dists -- Distance column
+    nears -- Nearest peaks of each gene or None
+    Returns: None
+
+    """
+    with open(part_file(path), 'wb') as fckpt:
+        flags.tofile(fckpt)
+        dists.tofile(fckpt)
+        if nears is not None:
+            fckpt.write('\n'.join(nears).encode('utf-8'))
+    commit_file(path)
+
+
+def loadColumn(path, ngenes, nearest):
+    """Read the columns checkpointed by saveColumn.
+
+    Keyword arguments:
+    path -- Checkpoint file
+    ngenes -- Number of genes
+    nearest -- True if the nearest peaks were checkpointed
+    Returns: Flag column, distance column, nearest peaks or None
+
+    """
+    flags = array('b')
+    dists = array('l')
+    nears = None
+    with open(path, 'rb') as fckpt:
+        flags.fromfile(fckpt, ngenes)
+        dists.fromfile(fckpt, ngenes)
+        if nearest:
+            nears = fckpt.read().decode('utf-8').split('\n')
+    return flags, dists, nears
+
+
+def labelPeaks(peakFiles, labelStr):
+    """Name the columns of peak files.
+
+    Keyword arguments:
+    peakFiles -- List of peak files
+    labelStr -- Peak names listed in commas, '' names them by file
+    Returns: List of labels
+
+    """
+    if peakFiles.count(STDIN) > 1:
+        print('Error: The standard input is given as several peak files',
+              file=sys.stderr)
+        sys.exit()
     if '' == labelStr:
         peakLabels = peakFiles
     else:
@@ -379,40 +1637,320 @@ def check_peak(geneFile, peakFiles, outFile, distFile,
         # --label.
         if len(peakLabels) != len(peakFiles):
             peakLabels = peakFiles
-    bin2genes, gene2peaks = readGeneFile(geneFile, peakFiles)
-    for peakFile in peakFiles:
-        gene2peaks = readPeakFile(
-            peakFile, bin2genes, gene2peaks, updist, indist,
-            sco_threshold, macs2)
-    fout = open(outFile, 'w')
-    fdist = open(distFile, 'w')
-
-    fout.write('#gene')
-    fdist.write('#gene')
-
-    for peakLabel in peakLabels:
-        fout.write(',' + peakLabel)
-        fdist.write(',' + peakLabel)
-
-    fout.write('\n')
-    fdist.write('\n')
-    plist = sorted(gene2peaks.items(), key=lambda x: x[0])
-    for wline in range(len(plist)):
-        fout.write(plist[wline][0])
-        fdist.write(plist[wline][0])
+    if peakLabels is peakFiles and STDIN in peakFiles:
+        print('Error: Peaks read from the standard input need --label ' + \
+              'with one name per peak file', file=sys.stderr)
+        sys.exit()
+    return peakLabels
 
-        for peakFile in peakFiles:
-            flag = str(plist[wline][1][peakFile]['flag'])
-            fout.write(',' + flag)
-            dist = str(plist[wline][1][peakFile]['dist'])
-            if str(DEFAULT_VALUE) in dist:
-                dist = '-'
-            fdist.write(',' + dist)
-        fout.write('\n')
-        fdist.write('\n')
 
-    fout.close()
-    fdist.close()
+def openTables(outFile, distFile, peakLabels):
+    """Open the flag and distance outputs and write their header.
+
+    Keyword arguments:
+    outFile -- Output file (existance)
+    distFile -- Output file (distance)
+    peakLabels -- List of labels
+    Returns: File objects of outFile and distFile
+
+    """
+    fout = open_output(outFile)
+    fdist = open_output(distFile)
+    fout.write('#gene,' + ','.join(peakLabels) + '\n')
+    fdist.write('#gene,' + ','.join(peakLabels) + '\n')
+    return fout, fdist
+
+
+def check_peak(geneFile, peakFiles, outFile, distFile,
+    updist, indist, labelStr, sco_threshold, macs2,
+    prefetch=PREFETCH_DEFAULT, npyPrefix='', memory=MEMORY_DEFAULT,
+    nearest=NEAREST_DEFAULT, nearFile='', sortedInput=False, metrics=None,
+    geneWorkers=GENE_WORKERS_DEFAULT, mergeInput=False, workDir='',
+    workers=WORKERS_DEFAULT, lazyAnnotation=False,
+    validate=VALIDATE_DEFAULT, countIndex=False, geneFormat=None,
+    summit=False, interrupt=None):
+    # Standard input and named pipes are read once: they are not scanned
+    # ahead for --lazy-annotation nor checkpointed, and need --label.
+    streams = [is_stream(x) for x in peakFiles]
+    peakLabels = labelPeaks(peakFiles, labelStr)
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage('annotation', [geneFile]) as stage:
+        loadChroms = None
+        if lazyAnnotation and any(streams):
+            print('Warning: Peak files are read once from a pipe, ' + \
+                  'all chromosomes of ' + geneFile + ' are loaded',
+                  file=sys.stderr)
+        elif lazyAnnotation:
+            loadChroms = peakChroms(peakFiles, sortedInput)
+        bin2genes, genes, chroms = readGeneFile(geneFile, metrics,
+                                               geneWorkers, loadChroms,
+                                               validate, geneFormat)
+        bin2genes = binWindows(bin2genes, updist, indist)
+        if countIndex:
+            stage['index'] = indexStats(bin2genes, chroms)
+    order = sorted(range(len(genes)), key=genes.__getitem__)
+
+    # Without a memory budget all columns are one block kept in memory.
+    # Otherwise blocks of columns are spilled to disk and joined at the end.
+    blockSize = len(peakFiles)
+    spillDir = None
+    if memory > 0:
+        blockSize = max(1, int(memory * 1024 * 1024) //
+                        (max(1, len(genes)) * COLUMN_BYTES))
+    if blockSize < len(peakFiles):
+        spillDir = tempfile.mkdtemp(
+            prefix='check_peak',
+            dir=os.path.dirname(os.path.abspath(outFile)))
+    # the spill directory, worker pool and shared index are removed even
+    # when a peak file fails
+    pool = None
+    indexFile = None
+    try:
+        if '' != npyPrefix:
+            fnpyFlag, fnpyDist = openBinary(npyPrefix, genes, order,
+                                            peakLabels)
+        if sortedInput or summit:
+            windows = sortWindows(bin2genes, updist, indist)
+
+        # Columns of peak files finished by an interrupted run are read back
+        # from the work directory, only the other files are read.
+        ckpts = [None] * len(peakFiles)
+        resumed = [False] * len(peakFiles)
+        if '' != workDir:
+            params = (updist, indist, sco_threshold, macs2, sortedInput,
+                      nearest, INDEX_VERSION, summit, geneFormat)
+            for col, peakFile in enumerate(peakFiles):
+                if streams[col]:
+                    continue
+                ckpts[col] = checkpoint_file(
+                    workDir, 'peak%d' % col,
+                    checkpoint_key([geneFile, peakFile], params))
+                resumed[col] = os.path.exists(ckpts[col])
+        todo = [x for x, y in zip(peakFiles, resumed) if not y]
+
+        # Worker processes share the bin index through a memory-mapped file
+        # and return the columns of one peak file each, in order. Worker
+        # processes do not inherit the standard input.
+        if workers > 1 and not sortedInput and 0 == nearest and \
+           not countIndex and not summit and todo and STDIN not in todo:
+            findex, indexFile = tempfile.mkstemp(
+                prefix='check_peak', suffix='.idx',
+                dir=os.path.dirname(os.path.abspath(outFile)))
+            os.close(findex)
+            writeSharedIndex(indexFile, bin2genes)
+            pool = multiprocessing.Pool(min(workers, len(todo)),
+                                        attachSharedIndex, (indexFile,))
+            pending = boundedMap(pool, scanPeakFile, [
+                (peakFile, chroms, len(genes), updist, indist, sco_threshold,
+                 macs2, mergeInput, validate) for peakFile in todo],
+                POOL_DEPTH * workers)
+        else:
+            pending = prefetchPeakFiles(todo, sco_threshold, macs2, prefetch,
+                                        sortedInput, metrics, validate, summit)
+
+        # one flag and one distance column per peak file, indexed by gene
+        flags = []
+        dists = []
+        spills = []
+        nears = []
+        for col, peakFile in enumerate(peakFiles):
+            # lets the caller stop the run, e.g. when a concurrent stage
+            # failed
+            if interrupt is not None:
+                interrupt()
+            stats = None
+            if resumed[col]:
+                with metrics.stage('peaks') as stage:
+                    stage['file'] = peakFile
+                    stage['resumed'] = True
+                    flag, dist, near = loadColumn(ckpts[col], len(genes),
+                                                  0 < nearest)
+                    flags.append(flag)
+                    dists.append(dist)
+                    if 0 < nearest:
+                        nears.append(near)
+            elif pool is not None:
+                with metrics.stage('peaks', [peakFile]) as stage:
+                    stage['file'] = peakFile
+                    result = next(pending)
+                    if result is None:
+                        sys.exit()
+                    flag, dist, metrics.inputs[peakFile], merged = result
+                    if merged is not None:
+                        stage['merged_peaks'] = merged
+                    flags.append(flag)
+                    dists.append(dist)
+            else:
+                chunks = next(pending)[1]
+                with metrics.stage('peaks', [peakFile]) as stage:
+                    stage['file'] = peakFile
+                    if 0 < nearest:
+                        chunks = list(chunks)
+                        nears.append(nearestPeaks(bin2genes, len(genes),
+                                                  sortPeaks(chunks, chroms),
+                                                  nearest, summit))
+                    if mergeInput:
+                        chunks = mergePeaks(chunks, sortedInput, stage)
+                    flags.append(array('b', [0]) * len(genes))
+                    dists.append(array('l', [DEFAULT_VALUE]) * len(genes))
+                    if summit:
+                        summitPeakFile(chunks, chroms, windows, flags[-1],
+                                       dists[-1], updist, indist)
+                    elif sortedInput:
+                        sweepPeakFile(chunks, chroms, windows, flags[-1],
+                                      dists[-1], updist, indist)
+                    else:
+                        if countIndex:
+                            stats = {}
+                        readPeakFile(
+                            peakFile, bin2genes, chroms, flags[-1], dists[-1],
+                            updist, indist, sco_threshold, macs2, chunks,
+                            stats)
+            if ckpts[col] is not None and not resumed[col]:
+                saveColumn(ckpts[col], flags[-1], dists[-1],
+                           nears[-1] if 0 < nearest else None)
+            metrics.peaks[peakLabels[col]] = {
+                'file': peakFile, 'genes_with_hits': sum(flags[-1])}
+            if stats is not None:
+                metrics.peaks[peakLabels[col]]['index'] = stats
+            if len(flags) == blockSize or col == len(peakFiles) - 1:
+                if '' != npyPrefix:
+                    appendColumns(fnpyFlag, flags, order)
+                    appendColumns(fnpyDist, dists, order)
+                if spillDir is not None:
+                    spills.append(
+                        spillBlock(spillDir, len(spills), order, flags, dists))
+                    flags = []
+                    dists = []
+        if pool is not None:
+            pool.close()
+            pool.join()
+            pool = None
+        if '' != npyPrefix:
+            fnpyFlag.close()
+            fnpyDist.close()
+
+        stage = metrics.start('output')
+        fout, fdist = openTables(outFile, distFile, peakLabels)
+        if spillDir is None:
+            writeRows(fout, fdist, order, flags, dists, genes)
+        else:
+            mergeBlocks(fout, fdist, genes, order, spills, spillDir)
+
+        fout.close()
+        fdist.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if indexFile is not None:
+            os.remove(indexFile)
+        if spillDir is not None:
+            shutil.rmtree(spillDir)
+
+    if 0 < nearest:
+        with open_output(nearFile) as fnear:
+            fnear.write('#gene,' + ','.join(peakLabels) + '\n')
+            for g in order:
+                fnear.write(genes[g])
+                for near in nears:
+                    fnear.write(',' + near[g])
+                fnear.write('\n')
+    metrics.stop(stage)
+
+
+def check_peak_batch(geneFiles, peakFiles, outFiles, distFiles,
+    updist, indist, labelStr, sco_threshold, macs2,
+    prefetch=PREFETCH_DEFAULT, sortedInput=False, metrics=None,
+    geneWorkers=GENE_WORKERS_DEFAULT, mergeInput=False,
+    lazyAnnotation=False, validate=VALIDATE_DEFAULT, geneFormat=None,
+    summit=False, interrupt=None):
+    """Run check_peak for several gene files reading each peak file once.
+
+    The bin indexes of all gene files are kept in memory and every chunk
+    of peaks is looked up in each of them before the next one is read,
+    so the peak files are parsed once whatever the number of gene files.
+
+    Keyword arguments:
+    geneFiles -- List of gene files
+    outFiles -- Output files (existance), one per gene file
+    distFiles -- Output files (distance), one per gene file
+    interrupt -- Function called before each peak file, it may exit
+    The other arguments are those of check_peak.
+    Returns: None
+
+    """
+    streams = [is_stream(x) for x in peakFiles]
+    peakLabels = labelPeaks(peakFiles, labelStr)
+    if metrics is None:
+        metrics = Metrics()
+    loadChroms = None
+    if lazyAnnotation and any(streams):
+        print('Warning: Peak files are read once from a pipe, ' + \
+              'all chromosomes of the gene files are loaded',
+              file=sys.stderr)
+    elif lazyAnnotation:
+        loadChroms = peakChroms(peakFiles, sortedInput)
+    indexes = []
+    for geneFile in geneFiles:
+        with metrics.stage('annotation', [geneFile]) as stage:
+            stage['file'] = geneFile
+            bin2genes, genes, chroms = readGeneFile(geneFile, metrics,
+                                                   geneWorkers, loadChroms,
+                                                   validate, geneFormat)
+            bin2genes = binWindows(bin2genes, updist, indist)
+            windows = None
+            if sortedInput or summit:
+                windows = sortWindows(bin2genes, updist, indist)
+            indexes.append((bin2genes, genes, chroms, windows))
+
+    # one flag and one distance column per gene file and peak file
+    flags = [[] for x in indexes]
+    dists = [[] for x in indexes]
+    pending = prefetchPeakFiles(peakFiles, sco_threshold, macs2, prefetch,
+                                sortedInput, metrics, validate, summit)
+    for col, peakFile in enumerate(peakFiles):
+        if interrupt is not None:
+            interrupt()
+        chunks = next(pending)[1]
+        with metrics.stage('peaks', [peakFile]) as stage:
+            stage['file'] = peakFile
+            if mergeInput:
+                chunks = mergePeaks(chunks, sortedInput, stage)
+            # sweep position of each index, kept from chunk to chunk
+            states = []
+            for k, (bin2genes, genes, chroms, windows) in enumerate(indexes):
+                flags[k].append(array('b', [0]) * len(genes))
+                dists[k].append(array('l', [DEFAULT_VALUE]) * len(genes))
+                states.append([None, 0])
+            for chunk in chunks:
+                for k, (bin2genes, genes, chroms, windows) in \
+                        enumerate(indexes):
+                    if summit:
+                        summitPeakFile([chunk], chroms, windows,
+                                       flags[k][-1], dists[k][-1],
+                                       updist, indist)
+                    elif sortedInput:
+                        sweepPeakFile([chunk], chroms, windows,
+                                      flags[k][-1], dists[k][-1],
+                                      updist, indist, states[k])
+                    else:
+                        readPeakFile(peakFile, bin2genes, chroms,
+                                     flags[k][-1], dists[k][-1], updist,
+                                     indist, sco_threshold, macs2, [chunk])
+        metrics.peaks[peakLabels[col]] = {
+            'file': peakFile, 'genes_with_hits': dict(
+                [(geneFile, sum(flag[-1]))
+                 for geneFile, flag in zip(geneFiles, flags)])}
+
+    stage = metrics.start('output')
+    for k, (bin2genes, genes, chroms, windows) in enumerate(indexes):
+        order = sorted(range(len(genes)), key=genes.__getitem__)
+        fout, fdist = openTables(outFiles[k], distFiles[k], peakLabels)
+        writeRows(fout, fdist, order, flags[k], dists[k], genes)
+        fout.close()
+        fdist.close()
+    metrics.stop(stage)
 
 
 if __name__ == '__main__':
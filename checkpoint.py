@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""checkpoint.py keeps completed units of a chip2lamp.py run in a work
+directory so that an interrupted run can resume.
+
+@author:     LAMP dev team
+@copyright:  LAMP dev team
+@license:    GPLv3
+@contact:    lamp_staff(AT)googlegroups.com
+@deffield    updated: Updated
+
+"""
+import os
+import hashlib
+
+KEY_LENGTH = 16 # hex digits of the key in checkpoint file names
+PART_SUFFIX = '.part'
+
+
+def checkpoint_key(files, params):
+    """Build the key of a unit from its inputs and parameters.
+
+    A checkpoint is only reused when the input files are unchanged (same
+    path, size and modification time) and the parameters are equal.
+
+    Keyword arguments:
+    files -- List of input files
+    params -- Tuple of parameters affecting the result
+    Returns: Hex string
+
+    """
+    digest = hashlib.sha1()
+    for filename in files:
+        st = os.stat(filename)
+        digest.update(('%s\t%d\t%r\n' % (
+            os.path.abspath(filename), st.st_size,
+            st.st_mtime)).encode('utf-8'))
+    digest.update(repr(params).encode('utf-8'))
+    return digest.hexdigest()[:KEY_LENGTH]
+
+
+def checkpoint_file(work_dir, name, key):
+    """Path of the checkpoint of a unit.
+
+    Keyword arguments:
+    work_dir -- Work directory
+    name -- Unit name
+    key -- Key from checkpoint_key
+    Returns: Path
+
+    """
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    return os.path.join(work_dir, '%s.%s' % (name, key))
+
+
+def part_file(path):
+    """Path a checkpoint is written to before commit_file."""
+    return path + PART_SUFFIX
+
+
+def commit_file(path):
+    """Mark a checkpoint complete by renaming its part file.
+
+    The rename is atomic, so a checkpoint either exists complete or not
+    at all, whenever the run is interrupted.
+    """
+    os.rename(part_file(path), path)
@@ -15,9 +15,19 @@ import sys
 import os
 import re
 import subprocess
+import multiprocessing
 from optparse import OptionParser
-from check_exp import check_exp
-from check_peak import check_peak
+from check_exp import check_exp_variants, make_variants, variant_file
+from check_peak import check_peak, check_peak_batch
+from gene_file import GENE_FORMATS
+from metrics import Metrics
+from text_file import open_output, is_stream, COMPRESS_TYPES, STDIN
+from validation import VALIDATE_LEVELS, VALIDATE_DEFAULT
+from checkpoint import checkpoint_key, checkpoint_file, part_file, commit_file
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # __all__ = []
 __version__ = 1.0
@@ -35,6 +45,14 @@ Q_THRESHOLD_DEFAULT = 0.05
 Q_COLUMN_DEFAULT = 12
 EXP_THRESHOLD_DEFAULT = 0.0
 OUT_DEFAULT = 'out'
+USE_TYPE_DEFAULT = 'b'
+PREFETCH_DEFAULT = 0
+MEMORY_DEFAULT = 0
+NEAREST_DEFAULT = 0
+WORKERS_DEFAULT = 1
+GENE_WORKERS_DEFAULT = 1
+MISSING_WARNINGS = 10 # warnings printed per file for genes not found
+EXPRESSION_POLL = 1.0 # seconds between checks of the expression process
 
 
 def usage(program_name):
@@ -46,10 +64,16 @@ def usage(program_name):
     Returns: None
 
     """
-    print('Usage: ' + program_name + ' --gene genes.gtf --diff gene_exp.diff --peak peakFile [peakFile2 peakFile3 ...]' \
+    print('Usage: ' + program_name + ' --gene genes.gtf[,genes2.gtf ...] --diff gene_exp.diff --peak peakFile [peakFile2 peakFile3 ...]' \
           ' [--exp ' + str(EXP_THRESHOLD_DEFAULT) + '] [--qval ' + str(Q_THRESHOLD_DEFAULT) + '] [--qcol ' + str(Q_COLUMN_DEFAULT) + ']' \
-        ' [--up ' + str(UPDIST_DEFAULT) + '] [--in ' + str(INDIST_DEFAULT) + '] [--out ' + str(OUT_DEFAULT) + ']' \
-        ' [--label TF1,TF2, ...] [--peakcheck] [--macs2]')
+        ' [--up ' + str(UPDIST_DEFAULT) + '] [--in ' + str(INDIST_DEFAULT) + '] [--out ' + str(OUT_DEFAULT) + '[,...]]' \
+        ' [--label TF1,TF2, ...] [--peakcheck] [--macs2 [--summit]] [--type ' + USE_TYPE_DEFAULT + ']' \
+        ' [--prefetch ' + str(PREFETCH_DEFAULT) + '] [--npy] [--memory MB]' \
+        ' [--nearest k] [--sorted] [--metrics-json metrics.json]' \
+        ' [--gene-workers ' + str(GENE_WORKERS_DEFAULT) + '] [--compress gz|xz]' \
+        ' [--merge-peaks] [--work-dir dir] [--workers ' + str(WORKERS_DEFAULT) + ']' \
+        ' [--lazy-annotation] [--validate full|sample|none]' \
+        ' [--index-stats] [--gene-format gtf|gff3]')
 
 
 def checkAllZero(arg0):
@@ -68,24 +92,70 @@ def checkAllZero(arg0):
     return retVal
 
 
-def check_consistency(expfile, peakfile, outexpfile, outpeakfile, peak_check):
+def warn_missing(missing, gene, filename):
+    """Warn about a gene not found in a file.
+
+    Only the first MISSING_WARNINGS genes are printed per file, the rest
+    is counted in missing and summarised by summarise_missing.
+
+    Keyword arguments:
+    missing -- Dictionary of file to genes not found in it
+    gene -- Gene
+    filename -- File the gene is missing from
+
+    Returns: None
+
+    """
+    genes = missing.setdefault(filename, [])
+    genes.append(gene)
+    if len(genes) <= MISSING_WARNINGS:
+        print('Warning: Gene %s is not found in %s.' % (
+            gene, filename), file=sys.stderr)
+
+
+def summarise_missing(missing, metrics):
+    """Summarise the genes counted by warn_missing.
+
+    Keyword arguments:
+    missing -- Dictionary of file to genes not found in it
+    metrics -- Metrics receiving the counts, or None
+
+    Returns: None
+
+    """
+    for filename, genes in sorted(missing.items()):
+        if len(genes) > MISSING_WARNINGS:
+            print('Warning: %d more genes are not found in %s.' % (
+                len(genes) - MISSING_WARNINGS, filename), file=sys.stderr)
+        if metrics is not None:
+            metrics.missing[filename] = {
+                'count': len(genes), 'examples': genes[:MISSING_WARNINGS]}
+
+
+def check_consistency(expfiles, peakfile, outexpfiles, outpeakfile, peak_check,
+                      metrics=None):
     """Check consistency between outputs of checkPeak.py and checkExp.py.
 
     Keyword arguments:
-    expfile -- Temporary output file of checkExp.py
+    expfiles -- Temporary output files of checkExp.py
     peakfile -- Temporary output file (peak) of checkPeak.py
-    outexpfile -- Final output file of checkExp.py
+    outexpfiles -- Final output files of checkExp.py
     outpeakfile -- Final output file of checkPeak.py
     peak_check -- 0: Use all genes, 1: Discard genes not binding to any TF.
+    metrics -- Metrics receiving the counts of missing genes
 
     Returns: None
 
     """
     peaks = {}
+    missing = {}
     sp = []
     headprog = re.compile('^#')
+    if isinstance(expfiles, str):
+        expfiles = [expfiles]
+        outexpfiles = [outexpfiles]
 
-    with open(outpeakfile, 'w') as outpeakfp, open(outexpfile, 'w') as outexpfp:
+    with open_output(outpeakfile) as outpeakfp:
         num = 0
         for line in open(peakfile, 'r'):
             num = num + 1
@@ -101,36 +171,120 @@ def check_consistency(expfile, peakfile, outexpfile, outpeakfile, peak_check):
                 sys.exit()
             peaks[sp[0]] = [checkAllZero(sp[1:]), line]
 
-        num = 0
-        for line in open(expfile, 'r'):
-            num = num + 1
-            line = line.rstrip()
-            if headprog.match(line):
-                print(line, file=outexpfp)
-                continue
-            sp = line.split(',')
-            size = len(sp)
-            if size < 2:
-                print('Error: Few columns at line %d in %s.' % (
-                    num, peakfile), file=sys.stderr)
-                sys.exit()
-            if peaks.get(sp[0], '') == '':
-                print('Warning: Gene %s is not found in %s.' % (
-                    sp[0], peakfile), file=sys.stderr)
+        # Every expression file lists the same genes, so the peak rows are
+        # written while reading the first one only.
+        for expfile, outexpfile in zip(expfiles, outexpfiles):
+            found = {}
+            with open_output(outexpfile) as outexpfp:
+                num = 0
+                for line in open(expfile, 'r'):
+                    num = num + 1
+                    line = line.rstrip()
+                    if headprog.match(line):
+                        print(line, file=outexpfp)
+                        continue
+                    sp = line.split(',')
+                    size = len(sp)
+                    if size < 2:
+                        print('Error: Few columns at line %d in %s.' % (
+                            num, peakfile), file=sys.stderr)
+                        sys.exit()
+                    if peaks.get(sp[0], '') == '':
+                        warn_missing(missing, sp[0], peakfile)
+                        continue
+
+                    if not peak_check or not peaks[sp[0]][0]:
+                        outexpfp.write(str(line) + '\n')
+                        if expfile == expfiles[0]:
+                            outpeakfp.write(str(peaks[sp[0]][1]) + '\n')
+                    found[sp[0]] = 1
+
+            for key in peaks:
+                if key not in found:
+                    warn_missing(missing, key, expfile)
+
+    summarise_missing(missing, metrics)
+
+
+def run_expression(results, genefiles, difffile, genecol, q_column,
+                   exp_column1, exp_column2, variants, outexpfiles,
+                   gene_workers, validate, gene_format, expdone=''):
+    """Run the expression stage in its own process.
+
+    Keyword arguments:
+    results -- Queue receiving the Metrics of the stage, or None if
+               check_exp failed
+    genefiles -- List of gene files
+    outexpfiles -- Lists of expression files, one list per gene file
+    expdone -- Marker file committed once the stage succeeded, '' for none
+    The other arguments are passed to check_exp_variants.
+
+    Returns: None
+
+    """
+    result = None
+    try:
+        metrics = Metrics()
+        for genefile, outexps in zip(genefiles, outexpfiles):
+            with metrics.stage('expression', [genefile, difffile]):
+                check_exp_variants(genefile, difffile, genecol, q_column,
+                                   exp_column1, exp_column2, variants,
+                                   outexps, metrics, gene_workers, validate,
+                                   gene_format)
+        if '' != expdone:
+            open(part_file(expdone), 'w').close()
+            commit_file(expdone)
+        result = metrics
+    finally:
+        # the parent waits for a result whatever the exception
+        results.put(result)
+
+
+def wait_expression(results, proc):
+    """Wait for the result of run_expression.
+
+    Keyword arguments:
+    results -- Queue passed to run_expression
+    proc -- Process running run_expression, None if it ran inline
+    Returns: Metrics, or None if the stage failed or its process died
+
+    """
+    while True:
+        try:
+            return results.get(timeout=EXPRESSION_POLL)
+        except queue.Empty:
+            if proc is not None and proc.exitcode is None:
                 continue
+        # a process killed before reporting leaves the queue empty
+        try:
+            return results.get(timeout=EXPRESSION_POLL)
+        except queue.Empty:
+            return None
+
 
-            if not peak_check:
-                outexpfp.write(str(line) + '\n')
-                outpeakfp.write(str(peaks[sp[0]][1]) + '\n')
-            elif not peaks[sp[0]][0]:
-                outexpfp.write(str(line) + '\n')
-                outpeakfp.write(str(peaks[sp[0]][1]) + '\n')
-            peaks[sp[0]] = ''
+def poll_expression(results, proc, received, outputs, wait=False):
+    """Exit if the expression stage failed.
+
+    Keyword arguments:
+    results -- Queue passed to run_expression
+    proc -- Process running run_expression, None if it ran inline
+    received -- List holding the result of the stage once received
+    outputs -- Files removed before exiting
+    wait -- True to wait for the stage to finish
+    Returns: Metrics, or None if the stage is still running
+
+    """
+    if not received:
+        if not wait and proc is not None and proc.exitcode is None:
+            return None
+        received.append(wait_expression(results, proc))
+    if received[0] is None:
+        for output in outputs:
+            if os.path.exists(output):
+                os.remove(output)
+        sys.exit()
+    return received[0]
 
-    for (key, value) in peaks.items():
-        if value is not '':
-            print('Warning: Gene %s is not found in %s.' % (
-                key, expfile), file=sys.stderr)
 
 def main(argv=None):
     program_name = os.path.basename(sys.argv[0])
@@ -142,7 +296,7 @@ def main(argv=None):
             flg = 0
             s = 0
             e = 0
-            op_part = re.compile('^-')
+            op_part = re.compile('^-.') # a lone '-' is the standard input
 
             for p in range(len(sys.argv)):
                 if sys.argv[p] in ('-p', '--peak'):
@@ -164,7 +318,8 @@ def main(argv=None):
                 '-g', '--gene', action='store',
                 dest='arg_gene',
                 default='',
-                help='Gene file in gtf/gff3 format')
+                help='Gene file in gtf/gff3 format(several listed in ' \
+                     'commas are computed in one pass over the peak files)')
             parser.add_option(
                 '--gcol', action='store',
                 dest='arg_gcol',
@@ -174,17 +329,19 @@ def main(argv=None):
                 '-d', '--diff', action='store',
                 dest='arg_diff',
                 default='',
-                help='Gene expression file created by cuffdiff')
+                help='Gene expression file created by cuffdiff(- reads ' \
+                     'the standard input)')
             parser.add_option(
                 '-o', '--out', action='store',
                 dest='arg_out',
                 default=OUT_DEFAULT,
-                help='Output prefix')
+                help='Output prefix(one per gene file listed in commas, ' \
+                     'by default the prefix and the gene file name)')
             parser.add_option(
                 '-q', '--qval', action='store',
                 dest='arg_qval',
                 default=Q_THRESHOLD_DEFAULT,
-                help='Maximum thhreshold of q-value(a non-negative value)')
+                help='Maximum thhreshold of q-value(non-negative values listed in commas)')
             parser.add_option(
                 '--qcol', action='store',
                 dest='arg_qcol', type='int',
@@ -194,7 +351,12 @@ def main(argv=None):
                 '-x', '--exp', action='store',
                 dest='arg_exp',
                 default=EXP_THRESHOLD_DEFAULT,
-                help='Minimum threshold of expression value(a non-negative value)')
+                help='Minimum threshold of expression value(non-negative values listed in commas)')
+            parser.add_option(
+                '-t', '--type', action='store',
+                dest='arg_type',
+                default=USE_TYPE_DEFAULT,
+                help='u: up only, d: down only, b: both(listed in commas)')
             parser.add_option(
                 '--ecol1', action='store',
                 dest='arg_ecol1', type='int',
@@ -209,7 +371,7 @@ def main(argv=None):
                 '-p', '--peak', action='store',
                 dest='arg_peak',
                 default='', nargs=n,
-                help='Peak files listed in spaces')
+                help='Peak files listed in spaces(- reads the standard input)')
             parser.add_option(
                 '-u', '--up', action='store',
                 dest='arg_up',
@@ -242,6 +404,94 @@ def main(argv=None):
                 dest='macs2',
                 default=False,
                 help='Use this option when the peak files are generated with MACS2.')
+            parser.add_option(
+                '--summit', action='store_true',
+                dest='arg_summit',
+                default=False,
+                help='Use the summits of MACS2 narrowPeak records instead ' \
+                     'of the peaks(with --macs2)')
+            parser.add_option(
+                '--prefetch', action='store',
+                dest='arg_prefetch', type='int',
+                default=PREFETCH_DEFAULT,
+                help='Number of threads reading peak files ahead(0 reads inline)')
+            parser.add_option(
+                '--npy', action='store_true',
+                dest='arg_npy',
+                default=False,
+                help='Also write flag and distance matrices in .npy format')
+            parser.add_option(
+                '--memory', action='store',
+                dest='arg_memory', type='float',
+                default=MEMORY_DEFAULT,
+                help='Memory budget(MB) for peak flag and distance columns, ' \
+                     'larger panels are processed in blocks spilled to disk')
+            parser.add_option(
+                '--nearest', action='store',
+                dest='arg_nearest', type='int',
+                default=NEAREST_DEFAULT,
+                help='Number of nearest peaks reported per gene at any distance')
+            parser.add_option(
+                '--sorted', action='store_true',
+                dest='arg_sorted',
+                default=False,
+                help='Peak files are sorted by chromosome and start position')
+            parser.add_option(
+                '--metrics-json', action='store',
+                dest='arg_metrics',
+                default='',
+                help='Output file of run metrics in JSON')
+            parser.add_option(
+                '--gene-workers', action='store',
+                dest='arg_gene_workers', type='int',
+                default=GENE_WORKERS_DEFAULT,
+                help='Number of processes parsing the gene file')
+            parser.add_option(
+                '--merge-peaks', action='store_true',
+                dest='arg_merge',
+                default=False,
+                help='Merge duplicate peaks before the overlap search')
+            parser.add_option(
+                '--work-dir', action='store',
+                dest='arg_work_dir',
+                default='',
+                help='Directory checkpointing the expression stage and ' \
+                     'finished peak files, a rerun resumes from them')
+            parser.add_option(
+                '--workers', action='store',
+                dest='arg_workers', type='int',
+                default=WORKERS_DEFAULT,
+                help='Number of processes computing peak files with a ' \
+                     'shared gene index(not with --sorted or --nearest)')
+            parser.add_option(
+                '--lazy-annotation', action='store_true',
+                dest='arg_lazy',
+                default=False,
+                help='Load only the chromosomes of the peak files through ' \
+                     'a sidecar index of the gene file')
+            parser.add_option(
+                '--validate', action='store',
+                dest='arg_validate',
+                default=VALIDATE_DEFAULT,
+                help='Numeric field checks: full(every line), sample(a ' \
+                     'prefix and a random sample) or none')
+            parser.add_option(
+                '--index-stats', action='store_true',
+                dest='arg_index_stats',
+                default=False,
+                help='Count bin index lookups per peak file in the ' \
+                     'run metrics(candidates, window hits, bin occupancy)')
+            parser.add_option(
+                '--compress', action='store',
+                dest='arg_compress',
+                default='',
+                help='Compress the text outputs(gz or xz)')
+            parser.add_option(
+                '--gene-format', action='store',
+                dest='arg_gene_format',
+                default=None,
+                help='Format of the gene file(gtf or gff3), by default ' \
+                     'from its extension')
 
             (o, a) = parser.parse_args()
             op = o.__dict__
@@ -249,9 +499,10 @@ def main(argv=None):
             genecol = int(op['arg_gcol'])
             difffile = op['arg_diff']
             out = op['arg_out']
-            q_threshold_default = float(op['arg_qval'])
+            q_thresholds = [float(x) for x in str(op['arg_qval']).split(',')]
             q_column_default = int(op['arg_qcol'])
-            exp_threshold_default = float(op['arg_exp'])
+            exp_thresholds = [float(x) for x in str(op['arg_exp']).split(',')]
+            use_types = op['arg_type'].split(',')
             exp_column1_default = int(op['arg_ecol1'])
             exp_column2_default = int(op['arg_ecol2'])
             peakfiles = op['arg_peak']
@@ -261,45 +512,184 @@ def main(argv=None):
             verbose = op['arg_verbose']
             label = op['arg_label']
             macs2 = op['macs2']
+            prefetch = op['arg_prefetch']
+            npy = op['arg_npy']
+            memory = op['arg_memory']
+            nearest = op['arg_nearest']
+            sortedInput = op['arg_sorted']
+            metrics_json = op['arg_metrics']
+            gene_workers = op['arg_gene_workers']
+            compress = op['arg_compress']
+            merge_peaks = op['arg_merge']
+            work_dir = op['arg_work_dir']
+            workers = op['arg_workers']
+            lazy_annotation = op['arg_lazy']
+            validate = op['arg_validate']
+            index_stats = op['arg_index_stats']
+            gene_format = op['arg_gene_format']
+            summit = op['arg_summit']
+            if str is type(peakfiles):
+                peakfiles = [peakfiles]
             if '' in (genefile, difffile):
                 raise TypeError()
 
             if 0 == len(peakfiles):
                 raise TypeError()
+
+            if min(q_thresholds) < 0 or min(exp_thresholds) < 0:
+                raise TypeError()
+            for use_type in use_types:
+                if use_type not in ('u', 'd', 'b'):
+                    raise TypeError()
+
+            if prefetch < 0 or memory < 0 or nearest < 0 or gene_workers < 1:
+                raise TypeError()
+
+            if '' != compress and compress not in COMPRESS_TYPES:
+                raise TypeError()
+
+            if workers < 1 or (workers > 1 and (sortedInput or 0 < nearest or
+                                                summit)):
+                raise TypeError()
+
+            if summit and not macs2:
+                raise TypeError()
+
+            if validate not in VALIDATE_LEVELS:
+                raise TypeError()
+
+            if gene_format not in (None,) + GENE_FORMATS:
+                raise TypeError()
+
+            # the standard input can be read by one input only
+            if STDIN == difffile and STDIN in peakfiles:
+                raise TypeError()
+
+            # Several gene files share one pass over the peak files in
+            # check_peak_batch, the expression file is read once per gene
+            # file.
+            genefiles = genefile.split(',')
+            outs = out.split(',')
+            if len(genefiles) > 1 and 1 == len(outs):
+                outs = [out + '_' + os.path.splitext(
+                    os.path.basename(x))[0] for x in genefiles]
+            if len(outs) != len(genefiles) or len(set(outs)) != len(outs):
+                raise TypeError()
+            if len(genefiles) > 1 and (npy or 0 < memory or 0 < nearest or
+                                       workers > 1 or index_stats or
+                                       '' != work_dir or STDIN == difffile):
+                raise TypeError()
         except:
             usage(program_name)
             return 2
 
-        outexp  = out + '_exp.txt'
-        outpeak = out + '_peak.txt'
-        outdist = out + '_dist.txt'
+        outpeaks = [x + '_peak.txt' for x in outs]
+        outnear = out + '_nearest.txt'
+        # temporary files stay plain, final outputs get the suffix
+        suffix = '.' + compress if '' != compress else ''
+        outdists = [x + '_dist.txt' + suffix for x in outs]
+        outnear += suffix
 
         print("Upstream from TSS (bp): %d" % updist, file=sys.stderr)
         print("Downstream from TSS (bp): %d" % indist, file=sys.stderr)
-        print("q-value threshold for DEG: %f" % q_threshold_default, file=sys.stderr)
+        print("q-value threshold for DEG: %s" % ', '.join(
+            ['%f' % q for q in q_thresholds]), file=sys.stderr)
         #print("q-value column num for DEG: %d" % q_column_default, file=sys.stderr)
 
-        # Execute checkExp.pl
-        tmpoutexp = outexp + '.tmp'
-        check_exp(genefile, difffile, genecol,
-                  q_threshold_default,
-                  q_column_default,
-                  exp_threshold_default,
-                  exp_column1_default,
-                  exp_column2_default,
-                  'b', tmpoutexp)
-
-        # Execute checkPeak.pl
-        tmpoutpeak = outpeak + '.tmp'
-        check_peak(genefile, peakfiles, tmpoutpeak,
-            outdist, updist, indist, label, 0.0, macs2)
-
-        check_consistency(tmpoutexp, tmpoutpeak, outexp, outpeak, peak_check)
-
-        # Remove temporary files
+        # Execute checkExp.pl, one output per threshold and direction
+        variants = make_variants(q_thresholds, exp_thresholds, use_types)
+        outexps = []
+        for x in outs:
+            outexp = x + '_exp.txt'
+            if len(variants) > 1:
+                outexps.append([variant_file(outexp, variant)
+                                for variant in variants])
+            else:
+                outexps.append([outexp])
+        tmpoutexps = [[x + '.tmp' for x in y] for y in outexps]
+        outexps = [[x + suffix for x in y] for y in outexps]
+        metrics = Metrics()
+
+        # With a work directory the expression outputs are kept there and
+        # a marker file tells a rerun that they are complete. An expression
+        # file read from a pipe is not checkpointed.
+        expdone = ''
+        if '' != work_dir and not is_stream(difffile):
+            key = checkpoint_key(genefiles + [difffile], (
+                genecol, q_column_default, exp_column1_default,
+                exp_column2_default, variants, gene_format))
+            tmpoutexps = [[checkpoint_file(
+                work_dir, 'exp%d' % (a * len(variants) + i), key)
+                for i in range(len(variants))] for a in range(len(outs))]
+            expdone = checkpoint_file(work_dir, 'expression', key)
+        # The expression stage runs in a separate process while the peak
+        # stage runs here, both are joined before check_consistency.
+        expresults = None
+        expproc = None
+        if '' != expdone and os.path.exists(expdone):
+            with metrics.stage('expression') as stage:
+                stage['resumed'] = True
+        else:
+            expresults = multiprocessing.Queue()
+            expargs = (expresults, genefiles, difffile, genecol,
+                       q_column_default, exp_column1_default,
+                       exp_column2_default, variants, tmpoutexps,
+                       gene_workers, validate, gene_format, expdone)
+            if STDIN == difffile:
+                # a child process gets no standard input, so the expression
+                # stage runs here before the peak stage
+                run_expression(*expargs)
+            else:
+                expproc = multiprocessing.Process(target=run_expression,
+                                                  args=expargs)
+                expproc.start()
+
+        # Execute checkPeak.pl. A failed expression stage stops it between
+        # peak files, its outputs are removed.
+        tmpoutpeaks = [x + '.tmp' for x in outpeaks]
+        peakoutputs = tmpoutpeaks + outdists
+        if 0 < nearest:
+            peakoutputs.append(outnear)
+        expreceived = []
+        interrupt = None
+        if expresults is not None:
+            interrupt = lambda: poll_expression(expresults, expproc,
+                                                expreceived, peakoutputs)
+        if len(genefiles) > 1:
+            check_peak_batch(genefiles, peakfiles, tmpoutpeaks, outdists,
+                updist, indist, label, 0.0, macs2, prefetch, sortedInput,
+                metrics, gene_workers, merge_peaks, lazy_annotation,
+                validate, gene_format, summit, interrupt)
+        else:
+            check_peak(genefile, peakfiles, tmpoutpeaks[0],
+                outdists[0], updist, indist, label, 0.0, macs2, prefetch,
+                out if npy else '', memory, nearest, outnear, sortedInput,
+                metrics, gene_workers, merge_peaks, work_dir, workers,
+                lazy_annotation, validate, index_stats, gene_format, summit,
+                interrupt)
+
+        if expresults is not None:
+            expmetrics = poll_expression(expresults, expproc, expreceived,
+                                         peakoutputs, True)
+            if expproc is not None:
+                expproc.join()
+            metrics.merge(expmetrics)
+
+        for a in range(len(outs)):
+            with metrics.stage('consistency'):
+                check_consistency(tmpoutexps[a], tmpoutpeaks[a], outexps[a],
+                                  outpeaks[a] + suffix, peak_check, metrics)
+
+        # Remove temporary files, checkpoints stay in the work directory
         if not verbose:
-            os.remove(tmpoutexp)
-            os.remove(tmpoutpeak)
+            for a in range(len(outs)):
+                if '' == work_dir:
+                    for tmpoutexp in tmpoutexps[a]:
+                        os.remove(tmpoutexp)
+                os.remove(tmpoutpeaks[a])
+
+        if '' != metrics_json:
+            metrics.write(metrics_json)
 
     #except Exception, e:
     #    indent = len(program_name) * ' '
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""gene_file.py reads gene records from gtf/gff3 files.
+
+@author:     LAMP dev team
+@copyright:  LAMP dev team
+@license:    GPLv3
+@contact:    lamp_staff(AT)googlegroups.com
+@deffield    updated: Updated
+
+"""
+import sys
+import os
+import io
+import re
+import multiprocessing
+from validation import line_sampler, VALIDATE_DEFAULT
+
+GTF = 'gtf'
+GFF3 = 'gff3'
+# features giving gene records
+FEATURES = {GTF: ('exon',), GFF3: ('gene', 'exon')}
+GENE_FORMATS = (GTF, GFF3)
+GENE_WORKERS_DEFAULT = 1
+RANGE_BYTES = 32 * 1024 * 1024 # bytes scanned per job with several workers
+CHROM_INDEX_SUFFIX = '.chroms' # sidecar index of chromosome byte ranges
+
+
+def gene_file_type(gene_file):
+    """Resolve the format of a gene file from its extension.
+
+    Keyword arguments:
+    gene_file -- Gene file in gtf/gff3 format
+    Returns: GTF or GFF3
+
+    """
+    file_part = re.compile('.*\.gtf$', re.I)
+    file_part2 = re.compile('.*\.gff3?$', re.I)
+    if file_part.search(gene_file) is not None:
+        return GTF
+    if file_part2.search(gene_file) is not None:
+        return GFF3
+    print('Error: Fail to open ' + \
+          gene_file + 'with unknown file extentions.', file=sys.stderr)
+    sys.exit()
+
+
+class GeneFileError(Exception):
+    """Malformed line of a gene file.
+
+    line is counted from the first line scanned, so a worker scanning a
+    byte range reports it relative to the range.
+    """
+
+    def __init__(self, line, what, column=''):
+        Exception.__init__(self, line, what, column)
+        self.line = line
+        self.what = what
+        self.column = column
+
+    def message(self, gene_file, offset=0):
+        return 'Error: ' + self.what + ' at line ' + \
+            str(self.line + offset) + self.column + ' in ' + gene_file
+
+
+def scan_lines(lines, file_type, counts, validate=VALIDATE_DEFAULT):
+    """Yield the gene records of lines of a gene file.
+
+    The feature column is checked before anything else is split or
+    validated, so lines of other features (transcript, CDS, UTR, ...) are
+    skipped after a few str.find calls. The gene name is taken from
+    gene_id "..." (gtf) or Name=...; (gff3) with one targeted scan.
+
+    Keyword arguments:
+    lines -- Iterable of lines
+    file_type -- GTF or GFF3
+    counts -- Dictionary receiving the line counts once all lines are read
+    validate -- Validation level of the numeric columns
+    Returns: Generator of (chrom, sta, end, strand, gene), sta is 0-based
+
+    """
+    features = FEATURES[file_type]
+    checked = line_sampler(validate)
+    id_part2 = re.compile('Name=(\w+);')
+    retsu_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
+
+    count = 0
+    ecount = 0
+    fcount = 0
+    icount = 0
+    rcount = 0
+    for line in lines:
+        count += 1
+        if line in ('\n', '\r') or 0 == line.find('#'):
+            ecount += 1
+            continue
+
+        # feature pushdown: look at column 3 before splitting the line
+        tab1 = line.find('\t')
+        tab2 = line.find('\t', tab1 + 1)
+        tab3 = line.find('\t', tab2 + 1)
+        if tab1 < 0 or tab2 < 0 or tab3 < 0:
+            raise GeneFileError(count, 'Less columns')
+        if line[tab2 + 1:tab3] not in features:
+            fcount += 1
+            continue
+
+        arr = line.split('\t', 8)
+        if 9 > len(arr):
+            raise GeneFileError(count, 'Less columns')
+
+        info = arr[8]
+        if GTF == file_type:
+            i = info.find('gene_id "')
+            if i < 0:
+                icount += 1
+                continue
+            i += len('gene_id "')
+            j = info.find('"', i)
+            if j <= i or info.find(';', j) != j + 1:
+                icount += 1
+                continue
+            gene = info[i:j]
+        else:
+            i = info.rfind('Name=')
+            if i <= 0:
+                icount += 1
+                continue
+            m = id_part2.match(info, i)
+            if m is None:
+                icount += 1
+                continue
+            gene = m.group(1)
+
+        if checked(count):
+            if None is retsu_part.search(arr[3]):
+                raise GeneFileError(count, 'Non-numeric value', ' column 4')
+
+            if None is retsu_part.search(arr[4]):
+                raise GeneFileError(count, 'Non-numeric value', ' column 5')
+
+        try:
+            sta = int(arr[3]) - 1
+            end = int(arr[4])
+        except ValueError:
+            raise GeneFileError(count, 'Non-numeric value')
+        rcount += 1
+        yield arr[0], sta, end, arr[6], gene
+
+    counts.update({'lines': count, 'records': rcount,
+                   'blank_or_comment': ecount, 'other_feature': fcount,
+                   'no_gene_name': icount})
+
+
+def split_ranges(gene_file, nranges):
+    """Split a file into byte ranges starting at line starts.
+
+    Keyword arguments:
+    gene_file -- File
+    nranges -- Number of ranges wanted
+    Returns: List of (start, stop)
+
+    """
+    size = os.path.getsize(gene_file)
+    bounds = [0]
+    with open(gene_file, 'rb') as fh:
+        for i in range(1, nranges):
+            fh.seek(max(bounds[-1], size * i // nranges))
+            fh.readline()
+            if fh.tell() >= size:
+                break
+            if fh.tell() > bounds[-1]:
+                bounds.append(fh.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def scan_range(job):
+    """Scan a byte range of a gene file in a worker process.
+
+    Keyword arguments:
+    job -- (gene_file, file_type, start, stop, validate)
+    Returns: List of records, Dictionary of line counts
+
+    """
+    gene_file, file_type, start, stop, validate = job
+    with open(gene_file, 'rb') as fh:
+        fh.seek(start)
+        data = fh.read(stop - start).decode('utf-8')
+    counts = {}
+    records = list(scan_lines(io.StringIO(data, newline=None),
+                              file_type, counts, validate))
+    return records, counts
+
+
+def build_chrom_index(filename, file_type=None, validate=VALIDATE_DEFAULT):
+    """Find the byte range of every chromosome of a tab separated file.
+
+    The lines of each chromosome (first column) must be contiguous, as in
+    a sorted file. Blank and comment lines belong to the range before
+    them. For gene files the gene names of every range are listed too, in
+    the order they first appear.
+
+    Keyword arguments:
+    filename -- Gene file or peak file
+    file_type -- GTF or GFF3 for gene files, None for peak files
+    validate -- Validation level of the numeric columns of gene files
+    Returns: List of (chrom, start, stop, lines before start, genes), or
+             None if the chromosomes are not contiguous
+
+    """
+    index = []
+    seen = set()
+    chrom = None
+    pos = 0
+    with open(filename, 'rb') as fh:
+        for count, line in enumerate(fh):
+            if line.strip() and not line.startswith(b'#'):
+                tab = line.find(b'\t')
+                name = (line[:tab] if tab >= 0 else line.rstrip()).decode(
+                    'utf-8')
+                if name != chrom:
+                    if name in seen:
+                        return None
+                    seen.add(name)
+                    if index:
+                        index[-1][2] = pos
+                    index.append([name, pos, None, count, []])
+                    chrom = name
+            pos += len(line)
+    if index:
+        index[-1][2] = pos
+
+    if file_type is not None:
+        for entry in index:
+            try:
+                records, counts = scan_range(
+                    (filename, file_type, entry[1], entry[2], validate))
+            except GeneFileError as e:
+                raise GeneFileError(e.line + entry[3], e.what, e.column)
+            genes = set()
+            for record in records:
+                if record[4] not in genes:
+                    genes.add(record[4])
+                    entry[4].append(record[4])
+    return [tuple(x) for x in index]
+
+
+def chrom_index(filename, file_type=None, validate=VALIDATE_DEFAULT):
+    """Read the sidecar chromosome index of a file, building it if needed.
+
+    The index is kept in filename + CHROM_INDEX_SUFFIX together with the
+    size and modification time of the file, and rebuilt when they change.
+
+    Keyword arguments:
+    filename -- Gene file or peak file
+    file_type -- GTF or GFF3 for gene files, None for peak files
+    validate -- Validation level used when the index is built
+    Returns: List returned by build_chrom_index, or None if the
+             chromosomes are not contiguous
+
+    """
+    st = os.stat(filename)
+    stamp = '#%d\t%r' % (st.st_size, st.st_mtime)
+    sidecar = filename + CHROM_INDEX_SUFFIX
+    try:
+        with open(sidecar, 'r') as fidx:
+            if fidx.readline().rstrip('\n') == stamp:
+                index = []
+                for line in fidx:
+                    arr = line.rstrip('\n').split('\t')
+                    index.append((arr[0], int(arr[1]), int(arr[2]),
+                                  int(arr[3]), arr[4:]))
+                return index
+    except IOError:
+        pass
+
+    index = build_chrom_index(filename, file_type, validate)
+    if index is None:
+        return None
+    try:
+        with open(sidecar, 'w') as fidx:
+            fidx.write(stamp + '\n')
+            for chrom, start, stop, line, genes in index:
+                fidx.write('\t'.join([chrom, str(start), str(stop),
+                                      str(line)] + genes) + '\n')
+    except IOError:
+        # a read-only directory only loses the cache
+        pass
+    return index
+
+
+def scan_gene_file(gene_file, metrics=None, workers=GENE_WORKERS_DEFAULT,
+                   chroms=None, validate=VALIDATE_DEFAULT, file_type=None):
+    """Yield the gene records of a gene file.
+
+    With several workers the file is split into line-aligned byte ranges
+    of about RANGE_BYTES, scanned by worker processes and merged back in
+    file order, so the records come out exactly as in a serial scan and
+    errors keep their line numbers.
+
+    With chroms, only the byte ranges of these chromosomes are parsed,
+    found with the sidecar index of chrom_index. The genes of the other
+    chromosomes are yielded from the index as (chrom, None, None, None,
+    gene), in file order, so gene numbering does not change. A file whose
+    chromosomes are not contiguous is read in full.
+
+    Keyword arguments:
+    gene_file -- Gene file in gtf/gff3 format
+    metrics -- Metrics receiving the line counts
+    workers -- Number of worker processes
+    chroms -- Set of chromosomes to parse, None parses all
+    validate -- Validation level of the numeric columns
+    file_type -- GTF or GFF3, None resolves it from the extension
+    Returns: Generator of (chrom, sta, end, strand, gene), sta is 0-based
+
+    """
+    if file_type is None:
+        file_type = gene_file_type(gene_file)
+    try:
+        fh = open(gene_file, 'r')
+    except IOError as e:
+        sys.stderr.write(e.strerror + ":" + gene_file + "\n")
+        sys.exit()
+
+    counts = {}
+    offset = 0
+    index = None
+    skipped = 0
+    try:
+        if chroms is not None:
+            index = chrom_index(gene_file, file_type, validate)
+            if index is None:
+                print('Warning: chromosomes are not contiguous in ' + \
+                      gene_file + ', all of them are loaded', file=sys.stderr)
+        if index is not None:
+            fh.close()
+            jobs = [(gene_file, file_type, x[1], x[2], validate)
+                    for x in index if x[0] in chroms]
+            pool = None
+            results = iter(map(scan_range, jobs))
+            if workers > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(min(workers, len(jobs)))
+                results = pool.imap(scan_range, jobs)
+            try:
+                for chrom, start, stop, line, genes in index:
+                    if chrom not in chroms:
+                        skipped += 1
+                        for gene in genes:
+                            yield chrom, None, None, None, gene
+                        continue
+                    offset = line
+                    records, part = next(results)
+                    for record in records:
+                        yield record
+                    for key, value in part.items():
+                        counts[key] = counts.get(key, 0) + value
+            finally:
+                if pool is not None:
+                    pool.terminate()
+        elif workers <= 1:
+            for record in scan_lines(fh, file_type, counts, validate):
+                yield record
+        else:
+            fh.close()
+            nranges = max(workers,
+                          os.path.getsize(gene_file) // RANGE_BYTES + 1)
+            jobs = [(gene_file, file_type, start, stop, validate)
+                    for start, stop in split_ranges(gene_file, nranges)]
+            pool = multiprocessing.Pool(workers)
+            try:
+                for records, part in pool.imap(scan_range, jobs):
+                    for record in records:
+                        yield record
+                    for key, value in part.items():
+                        counts[key] = counts.get(key, 0) + value
+                    offset = counts['lines']
+            finally:
+                pool.terminate()
+    except GeneFileError as e:
+        print(e.message(gene_file, offset), file=sys.stderr)
+        sys.exit()
+    fh.close()
+
+    if metrics is not None:
+        metrics.record(gene_file, {
+            'lines': counts.get('lines', 0),
+            'records': counts.get('records', 0),
+            'skipped': {'blank_or_comment': counts.get('blank_or_comment', 0),
+                        'other_feature': counts.get('other_feature', 0),
+                        'no_gene_name': counts.get('no_gene_name', 0),
+                        'chromosomes': skipped}})
+
+    if index:
+        return
+    if counts.get('lines', 0) - counts.get('blank_or_comment', 0) <= 0:
+        print('Error: No valid line in ' + gene_file, file=sys.stderr)
+        sys.exit()
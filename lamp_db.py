@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""lamp_db.py stores report_lamp.py results in SQLite and queries them.
+
+@author:     LAMP dev team
+@copyright:  LAMP dev team
+@license:    GPLv3
+@contact:    lamp_staff(AT)googlegroups.com
+@deffield    updated: Updated
+
+"""
+import os
+import sys
+import sqlite3
+from optparse import OptionParser
+
+DB_BATCH = 10000 # rows inserted per executemany
+SCHEMA = (
+    'CREATE TABLE labels (idx INTEGER PRIMARY KEY, label TEXT)',
+    'CREATE TABLE combinations (idx INTEGER PRIMARY KEY, combination TEXT)',
+    'CREATE TABLE genes (gene TEXT PRIMARY KEY, expressed INTEGER)',
+    'CREATE TABLE distances (gene TEXT, label INTEGER, distance INTEGER)',
+    'CREATE TABLE gene_combinations (gene TEXT, combination INTEGER, '
+    'status INTEGER)')
+INDEXES = (
+    'CREATE INDEX distances_gene ON distances (gene)',
+    'CREATE INDEX gene_combinations_gene ON gene_combinations (gene)',
+    'CREATE INDEX gene_combinations_combination '
+    'ON gene_combinations (combination, gene)',
+    'CREATE UNIQUE INDEX combinations_combination '
+    'ON combinations (combination)')
+
+
+class ResultStore(object):
+    """SQLite database of a report, filled gene by gene.
+
+    Only bound distances and non-empty combination cells are stored;
+    the indexes are built once all genes are in.
+    """
+
+    def __init__(self, db_file, labels, combs):
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        self.conn = sqlite3.connect(db_file)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.conn.executemany('INSERT INTO labels VALUES (?, ?)',
+                              enumerate(labels))
+        self.conn.executemany('INSERT INTO combinations VALUES (?, ?)',
+                              enumerate(combs))
+        self.genes = []
+        self.dists = []
+        self.cells = []
+
+    def add_gene(self, gene, expressed, values, status, empty):
+        """Add the row of a gene.
+
+        Keyword arguments:
+        gene -- Gene
+        expressed -- True if the gene is differentially expressed
+        values -- List of distances, '-' when not bound
+        status -- List of combination statuses
+        empty -- Status of an empty cell
+        Returns: None
+
+        """
+        self.genes.append((gene, 1 if expressed else 0))
+        for i, value in enumerate(values):
+            if value != '-':
+                self.dists.append((gene, i, int(value)))
+        for i, value in enumerate(status):
+            if value != empty:
+                self.cells.append((gene, i, value))
+        if len(self.genes) >= DB_BATCH:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany('INSERT INTO genes VALUES (?, ?)', self.genes)
+        self.conn.executemany('INSERT INTO distances VALUES (?, ?, ?)',
+                              self.dists)
+        self.conn.executemany(
+            'INSERT INTO gene_combinations VALUES (?, ?, ?)', self.cells)
+        self.genes = []
+        self.dists = []
+        self.cells = []
+
+    def close(self):
+        self.flush()
+        for statement in INDEXES:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self.conn.close()
+
+
+def gene_combinations(conn, gene):
+    """Combinations of a gene.
+
+    Keyword arguments:
+    conn -- sqlite3 connection
+    gene -- Gene
+    Returns: List of (combination, status)
+
+    """
+    return conn.execute(
+        'SELECT c.combination, g.status FROM gene_combinations g '
+        'JOIN combinations c ON c.idx = g.combination '
+        'WHERE g.gene = ? ORDER BY c.idx', (gene,)).fetchall()
+
+
+def gene_distances(conn, gene):
+    """Distances of a gene to the peaks of each label.
+
+    Keyword arguments:
+    conn -- sqlite3 connection
+    gene -- Gene
+    Returns: List of (label, distance)
+
+    """
+    return conn.execute(
+        'SELECT l.label, d.distance FROM distances d '
+        'JOIN labels l ON l.idx = d.label '
+        'WHERE d.gene = ? ORDER BY l.idx', (gene,)).fetchall()
+
+
+def combination_genes(conn, comb):
+    """Genes carrying a combination.
+
+    Keyword arguments:
+    conn -- sqlite3 connection
+    comb -- Combination, TFs listed in commas
+    Returns: List of (gene, status)
+
+    """
+    return conn.execute(
+        'SELECT g.gene, g.status FROM gene_combinations g '
+        'JOIN combinations c ON c.idx = g.combination '
+        'WHERE c.combination = ? ORDER BY g.gene', (comb,)).fetchall()
+
+
+def main():
+    try:
+        parser = OptionParser()
+        parser.add_option(
+            '--db', action='store', dest='arg_db', default='',
+            help='Database written by report_lamp.py --db')
+        parser.add_option(
+            '-g', '--gene', action='store', dest='arg_gene', default='',
+            help='Gene whose combinations and distances are listed')
+        parser.add_option(
+            '-c', '--comb', action='store', dest='arg_comb', default='',
+            help='Combination(TFs listed in commas) whose genes are listed')
+        (opt, args) = parser.parse_args()
+        arg = opt.__dict__
+        db_file = arg['arg_db']
+        gene = arg['arg_gene']
+        comb = arg['arg_comb']
+        if '' == db_file or ('' == gene) == ('' == comb):
+            raise TypeError()
+    except:
+        print('Usage: ' + str(sys.argv[0]) + \
+              ' --db report.sqlite (--gene gene | --comb TF1,TF2)')
+        sys.exit()
+
+    if not os.path.exists(db_file):
+        print('Error: Fail to open ' + db_file, file=sys.stderr)
+        sys.exit()
+    conn = sqlite3.connect(db_file)
+    if '' != gene:
+        print('#combination\tstatus')
+        for row in gene_combinations(conn, gene):
+            print('%s\t%d' % row)
+        print('#label\tdistance')
+        for row in gene_distances(conn, gene):
+            print('%s\t%d' % row)
+    else:
+        print('#gene\tstatus')
+        for row in combination_genes(conn, comb):
+            print('%s\t%d' % row)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
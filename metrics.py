@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""metrics.py collects run metrics of chip2lamp.py as JSON.
+
+@author:     LAMP dev team
+@copyright:  LAMP dev team
+@license:    GPLv3
+@contact:    lamp_staff(AT)googlegroups.com
+@deffield    updated: Updated
+
+"""
+import json
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """Counters and stage timings of a run.
+
+    inputs -- Dictionary of input file to its counters (lines parsed,
+              skipped lines by reason, records)
+    stages -- List of stages with their duration and throughput
+    peaks -- Dictionary of peak label to its counters
+    missing -- Dictionary of file to genes missing from it
+    """
+
+    def __init__(self):
+        self.inputs = {}
+        self.stages = []
+        self.peaks = {}
+        self.missing = {}
+
+    def record(self, name, counts):
+        """Set the counters of an input file.
+
+        Keyword arguments:
+        name -- Input file
+        counts -- Dictionary of counter to value
+        Returns: None
+
+        """
+        self.inputs.setdefault(name, {}).update(counts)
+
+    def merge(self, other):
+        """Add the metrics collected by another process.
+
+        Keyword arguments:
+        other -- Metrics
+        Returns: None
+
+        """
+        for name, counts in other.inputs.items():
+            self.record(name, counts)
+        self.stages.extend(other.stages)
+        self.peaks.update(other.peaks)
+        self.missing.update(other.missing)
+
+    def start(self, name, inputs=()):
+        """Start timing a stage of the run.
+
+        Keyword arguments:
+        name -- Stage name
+        inputs -- Input files read in the stage, their lines give the
+                  throughput
+        Returns: Dictionary of the stage, passed to stop
+
+        """
+        entry = {'stage': name, 'started': time.time(), 'inputs': inputs}
+        self.stages.append(entry)
+        return entry
+
+    def stop(self, entry):
+        """Stop timing a stage started with start.
+
+        Keyword arguments:
+        entry -- Dictionary returned by start
+        Returns: None
+
+        """
+        entry['seconds'] = time.time() - entry.pop('started')
+        inputs = entry.pop('inputs')
+        lines = sum([self.inputs.get(x, {}).get('lines', 0) for x in inputs])
+        if lines:
+            entry['lines'] = lines
+            if entry['seconds'] > 0:
+                entry['lines_per_second'] = lines / entry['seconds']
+
+    @contextmanager
+    def stage(self, name, inputs=()):
+        """Time a stage of the run with start and stop.
+
+        Keyword arguments:
+        name -- Stage name
+        inputs -- Input files read in the stage
+        Returns: Context manager giving the dictionary of the stage
+
+        """
+        entry = self.start(name, inputs)
+        yield entry
+        self.stop(entry)
+
+    def write(self, json_file):
+        """Write the metrics as JSON.
+
+        Keyword arguments:
+        json_file -- Output file
+        Returns: None
+
+        """
+        with open(json_file, 'w') as fjson:
+            json.dump({'inputs': self.inputs, 'stages': self.stages,
+                       'peaks': self.peaks, 'missing_genes': self.missing},
+                      fjson, indent=2, sort_keys=True)
+            fjson.write('\n')
@@ -13,6 +13,10 @@ from __future__ import print_function
 import re
 import sys
 from optparse import OptionParser
+from check_peak import NPY_DIST_SUFFIX, readBinaryDist
+from text_file import open_input, open_output
+from lamp_db import ResultStore
+from validation import line_sampler, VALIDATE_LEVELS, VALIDATE_DEFAULT
 
 
 RANK_THRESHOLD_DEFAULT = -1000000 #-sys.maxint
@@ -20,25 +24,64 @@ DEFAULT_VALUE = -10000000 #-sys.maxint
 SEP = '\t'
 
 
-def readFiles(lampfile, distfile, expfile, rank_threshold):
-    """Read peak files and set flag & distance to gene2peaks.
+def combColumns(combarr, labelarr):
+    """Resolve the distance columns of the TFs of every combination.
+
+    Keyword arguments:
+    combarr -- List of combinations
+    labelarr -- List of peak labels
+    Returns: List of (number of TFs, column indexes), one per combination
+
+    """
+    combcols = []
+    for comb in combarr:
+        tfArr = comb.split(',')
+        combcols.append((len(tfArr), [i for tf in tfArr
+                                      for i in range(len(labelarr))
+                                      if tf == labelarr[i]]))
+    return combcols
+
+
+def combStatus(combcols, values, expressed):
+    """Status of a gene in every combination.
+
+    A combination is 0 when all its TFs bind to the gene and 1 when the
+    gene is also differentially expressed, otherwise DEFAULT_VALUE.
+
+    Keyword arguments:
+    combcols -- List returned by combColumns
+    values -- List of distances of the gene
+    expressed -- True if the gene is differentially expressed
+    Returns: List of statuses
+
+    """
+    hit = 1 if expressed else 0
+    status = []
+    for ntf, cols in combcols:
+        tfCnt = 0
+        for i in cols:
+            if values[i] != '-':
+                tfCnt += 1
+        status.append(hit if tfCnt == ntf else DEFAULT_VALUE)
+    return status
+
+
+def readLampFile(lampfile, rank_threshold, validate=VALIDATE_DEFAULT):
+    """Read the combinations of a LAMP result.
 
     Keyword arguments:
     lampfile -- Output of LAMP
-    distfile -- Output of checkPeak.py
-    expfile  -- Output of checkExp.py
     rank_threshold -- Rank threshold
-    Returns: Dictionary, Dictionary, List, List
+    validate -- Validation level of the numeric columns
+    Returns: List of combinations
 
     """
-
-    gene2dist = {}
     combarr = []
-    gene2comb = {}
-    r_file = open(lampfile, 'r')
+    r_file = open_input(lampfile)
     count = 0
     ecount = 0
     retsu_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
+    checked = line_sampler(validate)
     for fh in r_file:
         count += 1
         if fh in ('\n', '\r'):
@@ -55,19 +98,26 @@ def readFiles(lampfile, distfile, expfile, rank_threshold):
                   str(count) + ' in ' + lampfile, file=sys.stderr)
             sys.exit()
 
-        if None is retsu_part.search(arr[0]):
-            print('Error: Non-numeric value at line ' + \
-                  str(count) + ' column 1 in ' + lampfile, file=sys.stderr)
-            sys.exit()
+        if checked(count):
+            if None is retsu_part.search(arr[0]):
+                print('Error: Non-numeric value at line ' + \
+                      str(count) + ' column 1 in ' + lampfile,
+                      file=sys.stderr)
+                sys.exit()
+
+            if None is retsu_part.search(arr[1]):
+                print('Error: Non-numeric value at line ' + \
+                      str(count) + ' column 2 in ' + lampfile,
+                      file=sys.stderr)
+                sys.exit()
 
-        if None is retsu_part.search(arr[1]):
+        try:
+            rank = int(arr[0])
+        except ValueError:
             print('Error: Non-numeric value at line ' + \
-                  str(count) + ' column 2 in ' + lampfile, file=sys.stderr)
+                  str(count) + ' column 1 in ' + lampfile, file=sys.stderr)
             sys.exit()
-
-        rank = int(arr[0])
         comb = arr[3]
-        labelarr = []
 
         if rank_threshold == RANK_THRESHOLD_DEFAULT or rank <= rank_threshold:
             combarr.append(comb)
@@ -77,65 +127,24 @@ def readFiles(lampfile, distfile, expfile, rank_threshold):
     if count - ecount <= 0:
         print('Error: No valid line in ' + lampfile, file=sys.stderr)
         sys.exit()
+    return combarr
 
-    count = 0
-    ecount = 0
-    retsuval = 2
-    r2_file = open(distfile, 'r')
-
-    for fh_2 in r2_file:
-        count += 1
-        if fh_2 in ('\n', '\r'):
-            ecount += 1
-            continue
-
-        arr_2 = fh_2.split(',')
-        if retsuval > len(arr_2):
-            print('Error: Less columns at line ' + \
-                  str(count) + ' in ' + distfile, file=sys.stderr)
-            sys.exit()
-
-        gene = arr_2[0]
-        arr_2 = arr_2[1:]
-
-        if gene == '#gene':
-            retsuval = len(arr_2) + 1
-            ecount += 1
-            labelarr = arr_2
-        else:
-            gene2dist[gene] = SEP.join(map(str, arr_2))
-
-            if len(labelarr) != len(arr_2):
-                print('Error: Less columns at line ' + \
-                      str(count) + ' in ' + distfile, file=sys.stderr)
-                sys.exit()
 
-            for comb_2 in combarr:
-                if gene not in gene2comb:
-                    gene2comb[gene] = {}
-                if comb_2 not in gene2comb[gene]:
-                    gene2comb[gene][comb_2] = DEFAULT_VALUE
+def readExpFile(expfile, validate=VALIDATE_DEFAULT):
+    """Read the differentially expressed genes of checkExp.py output.
 
-                tfCnt = 0
-                tfArr = comb_2.split(',')
-                for tf in tfArr:
-                    for i in range(len(arr_2)):
-                        label = labelarr[i]
-                        value = arr_2[i]
-                        if tf == label and value != '-':
-                          tfCnt = tfCnt + 1
-
-                if tfCnt == len(tfArr):
-                  gene2comb[gene][comb_2] = 0
-
-    r2_file.close()
+    Keyword arguments:
+    expfile  -- Output of checkExp.py
+    validate -- Validation level of the numeric columns
+    Returns: Set of genes whose expression is positive
 
-    if count - ecount <= 0:
-        print('Error: No valid line in ' + distfile, file=sys.stderr)
-        sys.exit()
+    """
+    expressed = set()
     count = 0
     ecount = 0
-    r3_file = open(expfile, 'r')
+    retsu_part = re.compile('^[-+]?\d+(\.\d+)?([eE][-+]?[0-9]+)?$')
+    checked = line_sampler(validate)
+    r3_file = open_input(expfile)
 
     for fh_3 in r3_file:
         count += 1
@@ -155,27 +164,162 @@ def readFiles(lampfile, distfile, expfile, rank_threshold):
                   str(count) + ' in ' + expfile, file=sys.stderr)
             sys.exit()
 
-        if None is retsu_part.search(arr_3[1]):
+        if checked(count) and None is retsu_part.search(arr_3[1]):
             print('Error: Non-numeric value at line ' + \
                   str(count) + ' column 2 in ' + expfile, file=sys.stderr)
             sys.exit()
 
-        gene = str(arr_3[0])
-        exp  = int(arr_3[1])
-        for comb_3 in combarr:
-            if gene2comb[gene][comb_3] != DEFAULT_VALUE and exp > 0:
-                gene2comb[gene][comb_3] = 1
+        try:
+            exp = int(arr_3[1])
+        except ValueError:
+            print('Error: Non-numeric value at line ' + \
+                  str(count) + ' column 2 in ' + expfile, file=sys.stderr)
+            sys.exit()
+        if exp > 0:
+            expressed.add(str(arr_3[0]))
     r3_file.close()
 
     if count - ecount <= 0:
         print('Error: No valid line in ' + expfile, file=sys.stderr)
         sys.exit()
+    return expressed
+
+
+def readDistFile(distfile):
+    """Read the distances of checkPeak.py output row by row.
+
+    Keyword arguments:
+    distfile -- Output of checkPeak.py, or its _dist.npy matrix
+    Returns: List of peak labels, generator of (gene, list of distances)
+
+    """
+    if distfile.endswith(NPY_DIST_SUFFIX):
+        return readBinaryDist(distfile)
+
+    r2_file = open_input(distfile)
+    count = 0
+    labelarr = None
+    for fh_2 in r2_file:
+        count += 1
+        if fh_2 in ('\n', '\r'):
+            continue
+        arr_2 = fh_2.rstrip('\r\n').split(',')
+        if 2 > len(arr_2) or arr_2[0] != '#gene':
+            print('Error: Less columns at line ' + \
+                  str(count) + ' in ' + distfile, file=sys.stderr)
+            sys.exit()
+        labelarr = arr_2[1:]
+        break
+    if labelarr is None:
+        print('Error: No valid line in ' + distfile, file=sys.stderr)
+        sys.exit()
+
+    def rows(count):
+        valid = 0
+        for fh_2 in r2_file:
+            count += 1
+            if fh_2 in ('\n', '\r'):
+                continue
+
+            arr_2 = fh_2.rstrip('\r\n').split(',')
+            if len(labelarr) + 1 != len(arr_2):
+                print('Error: Less columns at line ' + \
+                      str(count) + ' in ' + distfile, file=sys.stderr)
+                sys.exit()
+            valid += 1
+            yield arr_2[0], arr_2[1:]
+        r2_file.close()
+
+        if 0 == valid:
+            print('Error: No valid line in ' + distfile, file=sys.stderr)
+            sys.exit()
+
+    return labelarr, rows(count)
+
 
-    for i_2 in range(len(labelarr)):
-        st = ''.join(map(str, labelarr[i_2]))
-        st = st.rstrip()
-        labelarr[i_2] = 'Distance_' + ''.join(map(str, st))
-    return gene2comb, gene2dist, labelarr, combarr
+def distLabels(labelarr):
+    """Column names of the distances in the report."""
+    return ['Distance_' + label.rstrip() for label in labelarr]
+
+
+def readFiles(lampfile, distfile, expfile, rank_threshold,
+              validate=VALIDATE_DEFAULT):
+    """Read the LAMP result and checkPeak.py/checkExp.py outputs.
+
+    Keyword arguments:
+    lampfile -- Output of LAMP
+    distfile -- Output of checkPeak.py, or its _dist.npy matrix
+    expfile  -- Output of checkExp.py
+    rank_threshold -- Rank threshold
+    validate -- Validation level of the numeric columns
+    Returns: Dictionary, Dictionary, List, List
+
+    """
+    combarr = readLampFile(lampfile, rank_threshold, validate)
+    expressed = readExpFile(expfile, validate)
+    labelarr, rows = readDistFile(distfile)
+    combcols = combColumns(combarr, labelarr)
+    gene2comb = {}
+    gene2dist = {}
+    for gene, values in rows:
+        gene2dist[gene] = SEP.join(values)
+        gene2comb[gene] = dict(zip(combarr, combStatus(
+            combcols, values, gene in expressed)))
+    return gene2comb, gene2dist, distLabels(labelarr), combarr
+
+
+def writeReport(outFile, lampFile, distFile, expFile, rank_threshold,
+                longFormat=False, validate=VALIDATE_DEFAULT, dbFile=''):
+    """Write the report streaming the rows of the distance file.
+
+    Only the combinations and the set of expressed genes are held in
+    memory; each gene row is written as it is read, in the order of the
+    distance file (sorted by gene for checkPeak.py outputs). The long
+    format lists the (gene, combination, status) cells that are not
+    empty instead of the wide table.
+
+    Keyword arguments:
+    outFile -- Output file
+    lampFile -- Output of LAMP
+    distFile -- Output of checkPeak.py, or its _dist.npy matrix
+    expFile -- Output of checkExp.py
+    rank_threshold -- Rank threshold
+    longFormat -- True to write the long format
+    validate -- Validation level of the numeric columns
+    dbFile -- SQLite database also receiving the rows, see lamp_db.py
+    Returns: None
+
+    """
+    combArr = readLampFile(lampFile, rank_threshold, validate)
+    expressed = readExpFile(expFile, validate)
+    labelArr, rows = readDistFile(distFile)
+    combcols = combColumns(combArr, labelArr)
+    store = None
+    if '' != dbFile:
+        store = ResultStore(dbFile, labelArr, combArr)
+
+    o_file = open_output(outFile)
+    if longFormat:
+        o_file.write('#gene' + SEP + 'combination' + SEP + 'status\n')
+    else:
+        o_file.write('#gene' + SEP + SEP.join(combArr) +
+                     SEP + SEP.join(distLabels(labelArr)) + '\n')
+    for gene, values in rows:
+        status = combStatus(combcols, values, gene in expressed)
+        if store is not None:
+            store.add_gene(gene, gene in expressed, values, status,
+                           DEFAULT_VALUE)
+        if longFormat:
+            for comb, value in zip(combArr, status):
+                if value != DEFAULT_VALUE:
+                    o_file.write(gene + SEP + comb + SEP + str(value) + '\n')
+        else:
+            o_file.write(gene + SEP + SEP.join(
+                ['-' if x == DEFAULT_VALUE else str(x) for x in status]) +
+                SEP + SEP.join(values) + '\n')
+    o_file.close()
+    if store is not None:
+        store.close()
 
 
 def main():
@@ -192,7 +336,7 @@ def main():
         parser.add_option(
             '-d', '--dist', action='store',
             dest='arg_dist', default='',
-            help='Output of checkPeak.py')
+            help='Output of checkPeak.py(_dist.txt or _dist.npy)')
         parser.add_option(
             '-e', '--exp', action='store',
             dest='arg_exp', default='',
@@ -200,11 +344,26 @@ def main():
         parser.add_option(
             '-o', '--out', action='store',
             dest='arg_out', default='',
-            help='Output file')
+            help='Output file(.gz/.xz compressed by extension)')
         parser.add_option(
             '-r', '--rank', action='store', type='int',
             dest='arg_rank', default=RANK_THRESHOLD_DEFAULT,
             help='Rank threshold(a positive value)')
+        parser.add_option(
+            '--long', action='store_true',
+            dest='arg_long', default=False,
+            help='Write (gene, combination, status) rows of the ' + \
+                 'non-empty cells instead of the wide table')
+        parser.add_option(
+            '--validate', action='store',
+            dest='arg_validate', default=VALIDATE_DEFAULT,
+            help='Numeric field checks: full(every line), sample(a ' + \
+                 'prefix and a random sample) or none')
+        parser.add_option(
+            '--db', action='store',
+            dest='arg_db', default='',
+            help='SQLite database also receiving the report, ' + \
+                 'queried with lamp_db.py')
         (opt, args) = parser.parse_args()
         arg = opt.__dict__
         lampFile = arg['arg_lamp']
@@ -212,36 +371,25 @@ def main():
         expFile = arg['arg_exp']
         outFile = arg['arg_out']
         rank_threshold = arg['arg_rank']
+        longFormat = arg['arg_long']
+        validate = arg['arg_validate']
+        dbFile = arg['arg_db']
 
         if '' in (lampFile, distFile, expFile, outFile):
             raise TypeError()
         if rank_threshold != RANK_THRESHOLD_DEFAULT and rank_threshold < 1:
             raise TypeError()
+        if validate not in VALIDATE_LEVELS:
+            raise TypeError()
     except:
         print('Usage: ' + str(sys.argv[0]) + \
               ' --lamp out_lamp.txt --dist out_dist.txt' + \
-              ' --exp out_exp.txt --out out_report.txt [--rank rank]')
+              ' --exp out_exp.txt --out out_report.txt [--rank rank] [--long]' + \
+              ' [--validate full|sample|none] [--db report.sqlite]')
         sys.exit()
 
-    gene2comb, gene2dist, labelArr, combArr = readFiles(
-        lampFile, distFile, expFile, rank_threshold)
-    o_file = open(outFile, 'w')
-    o_file.write('#gene' + SEP + SEP.join(map(str, combArr)) +
-                 SEP + SEP.join(map(str, labelArr)) + '\n')
-    rlist = sorted(gene2comb.items(), key=lambda x: x[0])
-
-    for ritem in rlist:
-        gene = ritem[0]
-        o_file.write(gene)
-
-        for comb in combArr:
-            value = '-'
-            if gene2comb[gene][comb] != DEFAULT_VALUE:
-                value = gene2comb[gene][comb]
-            o_file.write(SEP + str(value))
-        o_file.write(SEP + str(gene2dist[gene]))
-    o_file.close()
-
+    writeReport(outFile, lampFile, distFile, expFile, rank_threshold,
+                longFormat, validate, dbFile)
 
 if __name__ == '__main__':
     main()
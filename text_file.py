@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""text_file.py opens plain, .gz and .xz text files of chip2lamp.py.
+
+@author:     LAMP dev team
+@copyright:  LAMP dev team
+@license:    GPLv3
+@contact:    lamp_staff(AT)googlegroups.com
+@deffield    updated: Updated
+
+"""
+import sys
+import os
+import io
+import stat
+import gzip
+import threading
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+GZ_SUFFIX = '.gz'
+XZ_SUFFIX = '.xz'
+COMPRESS_TYPES = ('gz', 'xz')
+STDIN = '-' # input file name reading the standard input
+BUFFER_CHARS = 1024 * 1024 # characters handed to the compressor at once
+QUEUE_DEPTH = 4 # buffers waiting for the compressor
+
+
+def compressor(filename):
+    """Resolve the compression module of a file from its extension.
+
+    Keyword arguments:
+    filename -- File
+    Returns: gzip, lzma or None for plain text
+
+    """
+    if filename.endswith(GZ_SUFFIX):
+        return gzip
+    if filename.endswith(XZ_SUFFIX):
+        if lzma is None:
+            print('Error: xz compression is not available for ' + filename,
+                  file=sys.stderr)
+            sys.exit()
+        return lzma
+    return None
+
+
+def is_stream(filename):
+    """Tell whether an input file can only be read once.
+
+    Keyword arguments:
+    filename -- File, STDIN for the standard input
+    Returns: True for the standard input and named pipes
+
+    """
+    if STDIN == filename:
+        return True
+    try:
+        return not stat.S_ISREG(os.stat(filename).st_mode)
+    except OSError:
+        return False
+
+
+def open_input(filename):
+    """Open a plain, .gz or .xz text file for reading.
+
+    Keyword arguments:
+    filename -- File, STDIN for the standard input
+    Returns: File object
+
+    """
+    if STDIN == filename:
+        # closing the returned file leaves sys.stdin open
+        return io.open(sys.stdin.fileno(), 'r', closefd=False)
+    module = compressor(filename)
+    if module is None:
+        return open(filename, 'r')
+    return io.TextIOWrapper(io.BufferedReader(module.open(filename, 'rb')))
+
+
+def open_output(filename):
+    """Open a plain, .gz or .xz text file for writing.
+
+    Keyword arguments:
+    filename -- File
+    Returns: File object, CompressedWriter for compressed files
+
+    """
+    module = compressor(filename)
+    if module is None:
+        return open(filename, 'w')
+    return CompressedWriter(filename, module)
+
+
+class CompressedWriter(object):
+    """Text file compressed by a background thread.
+
+    write() only collects text; full buffers are passed through a bounded
+    queue to a thread which encodes, compresses and writes them, so the
+    caller's loop overlaps with the compression. zlib and lzma release the
+    GIL while compressing.
+    """
+
+    def __init__(self, filename, module):
+        self.filename = filename
+        self.fh = module.open(filename, 'wb')
+        self.parts = []
+        self.size = 0
+        self.error = None
+        self.buffers = queue.Queue(QUEUE_DEPTH)
+        self.thread = threading.Thread(target=self.compress)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def compress(self):
+        while True:
+            text = self.buffers.get()
+            if text is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.fh.write(text.encode('utf-8'))
+            except BaseException as e:
+                self.error = e
+
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= BUFFER_CHARS:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.parts:
+            self.buffers.put(''.join(self.parts))
+            self.parts = []
+            self.size = 0
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.flush()
+        self.buffers.put(None)
+        self.thread.join()
+        self.thread = None
+        self.fh.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
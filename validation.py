@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""validation.py selects the input lines checked field by field.
+
+@author:     LAMP dev team
+@copyright:  LAMP dev team
+@license:    GPLv3
+@contact:    lamp_staff(AT)googlegroups.com
+@deffield    updated: Updated
+
+"""
+import random
+
+# full: every line, sample: a prefix and a random sample, none: no line;
+# lines not checked fail on the int()/float() conversion instead
+VALIDATE_FULL = 'full'
+VALIDATE_SAMPLE = 'sample'
+VALIDATE_NONE = 'none'
+VALIDATE_LEVELS = (VALIDATE_FULL, VALIDATE_SAMPLE, VALIDATE_NONE)
+VALIDATE_DEFAULT = VALIDATE_FULL
+SAMPLE_PREFIX = 1000 # lines always checked with sample
+SAMPLE_RATE = 0.01 # fraction of the later lines checked with sample
+SAMPLE_SEED = 0 # the sample is the same from run to run
+
+
+def line_sampler(level):
+    """Build the function telling whether a line gets the regex checks.
+
+    Keyword arguments:
+    level -- VALIDATE_FULL, VALIDATE_SAMPLE or VALIDATE_NONE
+    Returns: Function of the line number returning True or False
+
+    """
+    if VALIDATE_FULL == level:
+        return lambda count: True
+    if VALIDATE_NONE == level:
+        return lambda count: False
+    rand = random.Random(SAMPLE_SEED).random
+    return lambda count: count <= SAMPLE_PREFIX or rand() < SAMPLE_RATE